@@ -1,85 +1,488 @@
 import datetime
 import logging
 import os.path
+import shutil
+import socket
 import sys
+import time
+import traceback
+import typing
 
 import sam_interface
+import sam_interface.manifest as manifest
+import sam_interface.pipeline as pipeline
+import sam_interface.spool as spool
 
 
 logging.basicConfig(
-    format='(%(asctime)s) [%(levelname)-8.8s] %(message)s',
+    format='(%(asctime)s) [%(levelname)-8.8s] %(threadName)s: %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
 
-def process_image(path: str, output_dir: str):
-    if path.endswith(".dat"):
-        logging.info("Loading segment manager backup from file '{}'...".format(os.path.abspath(path)))
-        segment_manager = sam_interface.SegmentManager.load(path)
+MANIFEST_FILE = "manifest.json"
+
+
+class BatchJob:
+    def __init__(
+            self, path: str, output_dir: str, sam=None, batch_manifest: manifest.Manifest = None,
+            input_hash: str = None
+    ):
+        """
+        :param sam: an already loaded SAM model to segment with. If not specified, the model for the configured
+        checkpoint is taken from the process-wide model pool.
+        :param batch_manifest: the manifest of the output directory, shared by every job of the batch
+        :param input_hash: the hash of the input file, if already known
+        """
+        self.path = path
+        self.output_dir = output_dir
+        self.sam = sam
+
+        if batch_manifest is None:
+            batch_manifest = manifest.Manifest(os.path.join(output_dir, MANIFEST_FILE))
+
+        self.manifest = batch_manifest
+
+        self.name = get_export_name(path)
+        self.segment_manager = None
+        self.needs_segmentation = not path.endswith(".dat")
+        self.writes = []
+        self.start = datetime.datetime.now()
+
+        self.input_hash = input_hash
+        self.image_ext = None
+        self.artifact_settings = {}
+        self.stale_artifacts = set()
+
+        # the spool entry of the file, when running as a spool worker
+        self.lease = None
+
+    def get_segments_path(self) -> str:
+        return os.path.join(self.output_dir, self.name, "{}_segments.dat".format(self.name))
+
+    def get_artifact_settings(self) -> dict:
+        """
+        Returns the settings each requested artifact depends on, keyed by artifact
+        """
+        prefs = sam_interface.preferences.get_preferences()
+        export_prefs = prefs["export_options"]
+
+        if self.path.endswith(".dat"):
+            # the segments come from the backup, which is covered by the input hash
+            segmentation_settings = dict(source="backup")
+
+        else:
+            sam_checkpoint = prefs["sam_checkpoint"]
+            segmentation_settings = dict(
+                source="image", model_type=sam_checkpoint["model_type"],
+                checkpoint_path=os.path.abspath(sam_checkpoint["checkpoint_path"]),
+                min_sam_segment=prefs["min_sam_segment"]
+            )
+
+        detail_settings = dict(
+            segmentation_settings, min_area=export_prefs["min_area"], tolerance=export_prefs["tolerance"]
+        )
+
+        settings = dict(image={})
+
+        if self.needs_segmentation:
+            settings["segments"] = segmentation_settings
+
+        for artifact in sam_interface.export.ARTIFACT_FILES:
+            if export_prefs.get("save_{}".format(artifact), False):
+                settings[artifact] = (
+                    detail_settings if artifact in sam_interface.export.DETAIL_ARTIFACTS else segmentation_settings
+                )
+
+        return settings
+
+
+def load_stage(job: BatchJob) -> typing.Optional[BatchJob]:
+    job.start = datetime.datetime.now()
+
+    if job.input_hash is None:
+        job.input_hash = manifest.hash_file(job.path)
+
+    job.artifact_settings = job.get_artifact_settings()
+    job.stale_artifacts = job.manifest.get_stale_artifacts(job.name, job.input_hash, job.artifact_settings)
+
+    if not job.stale_artifacts - {"segments"}:
+        logging.info("Skipping '{}', all outputs are up to date".format(os.path.abspath(job.path)))
+        return None
+
+    logging.info("Creating {} for '{}'".format(", ".join(sorted(job.stale_artifacts)), os.path.abspath(job.path)))
+
+    if job.needs_segmentation and "segments" not in job.stale_artifacts:
+        logging.info("Loading previously detected segments from '{}'...".format(job.get_segments_path()))
+        job.segment_manager = sam_interface.SegmentManager.load(
+            job.get_segments_path(), load_interactive_segmentation=False, sam=job.sam
+        )
+        job.needs_segmentation = False
+
+    elif job.path.endswith(".dat"):
+        logging.info("Loading segment manager backup from file '{}'...".format(os.path.abspath(job.path)))
+        job.segment_manager = sam_interface.SegmentManager.load(
+            job.path, load_interactive_segmentation=False, sam=job.sam
+        )
 
     else:
-        logging.info("Loading segment manager on image '{}'...".format(os.path.abspath(path)))
+        logging.info("Loading segment manager on image '{}'...".format(os.path.abspath(job.path)))
         sam_checkpoint = sam_interface.preferences.get_sam_checkpoint()
 
-        segment_manager = sam_interface.segment_manager.SegmentManager(
-            path,
+        job.segment_manager = sam_interface.segment_manager.SegmentManager(
+            job.path,
             checkpoint_key=sam_checkpoint["model_type"],
             checkpoint_path=sam_checkpoint["checkpoint_path"],
-            auto_detect_masks=True, load_interactive_segmentation=False
+            auto_detect_masks=False, load_interactive_segmentation=False,
+            sam=job.sam
         )
 
-    name = os.path.splitext(os.path.basename(path))[0]
+    return job
+
+
+def segment_stage(job: BatchJob) -> BatchJob:
+    # backups and previous runs already contain their segments
+    if job.needs_segmentation:
+        # without a model passed to the job, the segment manager loads it from the model pool here, so it is only
+        # loaded once the first job which needs it gets this far, and then shared by every job
+        logging.info("Automatically detecting segments in '{}'...".format(job.name))
+        job.segment_manager.auto_detect_masks()
+
+        logging.info("Found {} valid masks in '{}'".format(len(job.segment_manager.masks), job.name))
+
+    return job
 
+
+def export_stage(job: BatchJob) -> BatchJob:
     logging.info(
-        "Exporting files based on preferences defined in '{}'".format(
-            os.path.abspath(sam_interface.preferences.PREFERENCES_FILE)
+        "Exporting '{}' based on preferences defined in '{}'".format(
+            job.name, os.path.abspath(sam_interface.preferences.PREFERENCES_FILE)
         )
     )
     prefs = sam_interface.preferences.get_preferences()
     export_prefs = prefs["export_options"]
 
+    stale = job.stale_artifacts
+
     sam_interface.export.full_export(
-        segment_manager, output_dir, name,
-        export_prefs["save_mask_tree"],
-        export_prefs["save_vector_tree"],
-        export_prefs["save_raster"],
-        export_prefs["save_centroids"],
-        export_prefs["save_detail_mask_tree"],
-        export_prefs["save_detail_vector_tree"],
-        export_prefs["save_detail_raster"],
+        job.segment_manager, job.output_dir, job.name,
+        "mask_tree" in stale,
+        "vector_tree" in stale,
+        "raster" in stale,
+        "centroids" in stale,
+        "detail_mask_tree" in stale,
+        "detail_vector_tree" in stale,
+        "detail_raster" in stale,
         export_prefs["min_area"],
-        export_prefs["tolerance"]
+        export_prefs["tolerance"],
+        export_prefs.get("detail_workers", 1),
+        writer=lambda function, *args: job.writes.append((function, args)),
+        save_image="image" in stale
     )
 
+    if "segments" in stale:
+        job.writes.append((job.segment_manager.save, (job.get_segments_path(), )))
 
-if __name__ == '__main__':
-    final_file_list = []
+    _, job.image_ext = os.path.splitext(job.segment_manager.image_path)
+
+    # the image and segments are no longer needed once the files to write are known
+    job.segment_manager = None
+    return job
+
+
+def write_stage(job: BatchJob) -> BatchJob:
+    # files are written to a temporary path and moved into place, so an interrupted run never leaves partial outputs
+    for function, args in job.writes:
+        sam_interface.export.write_atomic(function, *args)
+
+    job.writes = []
+
+    artifacts = {}
+    for artifact in job.stale_artifacts:
+        if artifact == "segments":
+            files = [job.get_segments_path()]
+
+        else:
+            files = sam_interface.export.get_artifact_paths(job.output_dir, job.name, artifact, job.image_ext)
+
+        artifacts[artifact] = (job.artifact_settings[artifact], files)
+
+    job.manifest.record(job.name, job.path, job.input_hash, artifacts)
+
+    logging.info("Finished '{}'. Took {}".format(os.path.abspath(job.path), datetime.datetime.now() - job.start))
+    return job
+
+
+def process_image(path: str, output_dir: str, sam=None):
+    job = BatchJob(path, output_dir, sam)
+
+    for stage in (load_stage, segment_stage, export_stage, write_stage):
+        job = stage(job)
+
+        if job is None:
+            return
+
+
+def get_export_name(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def deduplicate(paths: typing.List[str]) -> typing.Tuple[typing.Dict[str, str], typing.Dict[str, typing.List[str]]]:
+    """
+    Groups the files by content
+    :return: the hash of each file, and the paths of the files with the same content as each unique file, keyed by
+    the first path with that content
+    """
+    hashes = {}
+    primaries = {}
+    duplicates = {}
+
+    for path in paths:
+        hashes[path] = manifest.hash_file(path)
+
+        if hashes[path] in primaries:
+            duplicates[primaries[hashes[path]]].append(path)
+
+        else:
+            primaries[hashes[path]] = path
+            duplicates[path] = []
+
+    return hashes, duplicates
+
+
+def link_file(source: str, destination: str):
+    """
+    Hardlinks the destination to the source, copying it instead if hardlinks are not supported
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    temp_path = "{}.{}-{}.tmp".format(destination, socket.gethostname(), os.getpid())
+
+    try:
+        os.link(source, temp_path)
+
+    except OSError:
+        shutil.copy2(source, temp_path)
+
+    try:
+        os.replace(temp_path, destination)
 
-    for name in sys.argv[2:]:
+    finally:
+        # renaming a link over another link to the same file does nothing, leaving the temporary link in place
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+
+def link_duplicate(
+        primary_path: str, duplicate_path: str, output_dir: str, batch_manifest: manifest.Manifest, input_hash: str
+) -> int:
+    """
+    Creates the outputs of the duplicate from the outputs of the primary file with the same content, renamed to the
+    export name of the duplicate
+    :return: the number of bytes of outputs linked
+    """
+    primary_name = get_export_name(primary_path)
+    duplicate_name = get_export_name(duplicate_path)
+
+    if primary_name == duplicate_name:
+        return 0
+
+    entry = batch_manifest.get_entry(primary_name)
+
+    if entry is None or entry["input_hash"] != input_hash:
+        logging.warning("Not creating outputs of '{}', since its duplicate '{}' was not converted".format(
+            os.path.abspath(duplicate_path), os.path.abspath(primary_path)
+        ))
+        return 0
+
+    # outputs linked by an earlier run are kept while the duplicate's manifest entry is up to date
+    stale = batch_manifest.get_stale_artifacts(duplicate_name, input_hash, {
+        artifact: record["settings"] for artifact, record in entry["artifacts"].items()
+    })
+
+    if len(stale) == 0:
+        return 0
+
+    primary_dir = os.path.abspath(os.path.join(output_dir, primary_name))
+    duplicate_dir = os.path.join(output_dir, duplicate_name)
+
+    if not os.path.isdir(duplicate_dir):
+        os.makedirs(duplicate_dir)
+
+    linked_size = 0
+    artifacts = {}
+
+    for artifact, record in entry["artifacts"].items():
+        if artifact not in stale:
+            continue
+
+        files = []
+
+        for source in record["files"]:
+            file_name = os.path.relpath(source, primary_dir)
+            destination = os.path.join(duplicate_dir, duplicate_name + file_name[len(primary_name):])
+
+            link_file(source, destination)
+            linked_size += os.path.getsize(destination)
+            files.append(destination)
+
+        artifacts[artifact] = (record["settings"], files)
+
+    batch_manifest.record(duplicate_name, duplicate_path, input_hash, artifacts)
+
+    return linked_size
+
+
+def get_pipeline_stages() -> list:
+    pipeline_prefs = sam_interface.preferences.get_preferences()["batch_pipeline"]
+    queue_size = pipeline_prefs["queue_size"]
+
+    return [
+        pipeline.Stage("load", load_stage, pipeline_prefs["load_workers"], queue_size),
+        pipeline.Stage("segment", segment_stage, pipeline_prefs["segment_workers"], queue_size),
+        pipeline.Stage("export", export_stage, pipeline_prefs["export_workers"], queue_size),
+        pipeline.Stage("write", write_stage, pipeline_prefs["write_workers"], queue_size),
+    ]
+
+
+def claim_jobs(
+        batch_spool: spool.Spool, output_dir: str, batch_manifest: manifest.Manifest, poll_interval: float
+) -> typing.Iterator[BatchJob]:
+    """
+    Claims files from the spool until it is empty, and no other worker holds a lease which could still expire
+    """
+    while True:
+        lease = batch_spool.claim()
+
+        if lease is None:
+            if not batch_spool.has_work():
+                return
+
+            time.sleep(poll_interval)
+            continue
+
+        logging.info("Claimed '{}' from the spool".format(lease.path))
+
+        job = BatchJob(lease.path, output_dir, batch_manifest=batch_manifest)
+        job.lease = lease
+        yield job
+
+
+def finish_lease(batch_spool: spool.Spool, job: BatchJob, error: typing.Optional[Exception]):
+    if error is None:
+        batch_spool.complete(job.lease)
+
+    else:
+        batch_spool.fail(job.lease, "".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+
+def run_worker(spool_dir: str, output_dir: str):
+    spool_prefs = sam_interface.preferences.get_preferences()["batch_spool"]
+
+    batch_spool = spool.Spool(spool_dir, spool_prefs["lease_timeout"])
+    batch_spool.start_heartbeat()
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    batch_manifest = manifest.Manifest(os.path.join(output_dir, MANIFEST_FILE))
+
+    worker_start = datetime.datetime.now()
+    logging.info("Worker '{}' waiting for files from spool '{}'".format(
+        batch_spool.worker_id, os.path.abspath(spool_dir)
+    ))
+
+    pipeline.run_pipeline(
+        claim_jobs(batch_spool, output_dir, batch_manifest, spool_prefs["poll_interval"]),
+        get_pipeline_stages(),
+        on_finish=lambda job, error: finish_lease(batch_spool, job, error)
+    )
+
+    logging.info("Spool is empty, stopping worker. Took {}".format(datetime.datetime.now() - worker_start))
+
+
+def get_file_list(names: typing.List[str]) -> typing.List[str]:
+    file_list = []
+
+    for name in names:
         if os.path.isdir(name):
             for child in os.listdir(name):
                 child_path = os.path.join(name, child)
 
                 if os.path.isfile(child_path):
-                    final_file_list.append(child_path)
+                    file_list.append(child_path)
 
         elif os.path.isfile(name):
-            final_file_list.append(name)
+            file_list.append(name)
 
         else:
             logging.error("Specified file '{}' does not exist!".format(name))
 
+    return file_list
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == "--enqueue":
+        enqueue_spool = spool.Spool(sys.argv[2])
+
+        for file_path in get_file_list(sys.argv[3:]):
+            enqueue_spool.enqueue(file_path)
+            logging.info("Added '{}' to spool".format(os.path.abspath(file_path)))
+
+        sys.exit()
+
+    if sys.argv[1] == "--worker":
+        run_worker(sys.argv[2], sys.argv[3])
+        sys.exit()
+
+    final_file_list = get_file_list(sys.argv[2:])
+
     batch_size = len(final_file_list)
     logging.info("Found {} files to convert...".format(batch_size))
 
-    for i, image_path in enumerate(final_file_list):
-        logging.info("Processing file '{}' ({} of {})".format(
-            os.path.abspath(image_path), i + 1, batch_size
-        ))
+    output_directory = sys.argv[1]
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    batch_manifest = manifest.Manifest(os.path.join(output_directory, MANIFEST_FILE))
+
+    batch_start = datetime.datetime.now()
+
+    logging.info("Hashing files to find duplicates...")
+    input_hashes, duplicate_files = deduplicate(final_file_list)
 
-        start = datetime.datetime.now()
-        process_image(image_path, sys.argv[1])
-        end = datetime.datetime.now()
+    pipeline.run_pipeline(
+        (
+            BatchJob(image_path, output_directory, batch_manifest=batch_manifest, input_hash=input_hashes[image_path])
+            for image_path in duplicate_files
+        ),
+        get_pipeline_stages()
+    )
+
+    duplicate_count = 0
+    duplicate_input_size = 0
+    duplicate_output_size = 0
+
+    for primary_file, duplicates in duplicate_files.items():
+        for duplicate_file in duplicates:
+            logging.info("Linking outputs of '{}' to duplicate '{}'".format(
+                os.path.abspath(primary_file), os.path.abspath(duplicate_file)
+            ))
+
+            duplicate_count += 1
+            duplicate_input_size += os.path.getsize(duplicate_file)
+            duplicate_output_size += link_duplicate(
+                primary_file, duplicate_file, output_directory, batch_manifest, input_hashes[duplicate_file]
+            )
+
+    logging.info(
+        "Deduplication: {} of {} files were duplicates. Skipped converting {:.1f} MB of input, "
+        "linked {:.1f} MB of output.".format(
+            duplicate_count, batch_size, duplicate_input_size / 1024 ** 2, duplicate_output_size / 1024 ** 2
+        )
+    )
 
-        logging.info("Took {}".format(end - start))
+    logging.info("Converted {} files. Took {}".format(batch_size, datetime.datetime.now() - batch_start))
@@ -0,0 +1,95 @@
+import datetime
+import logging
+import sys
+
+import numpy as np
+import scipy.ndimage as ndimage
+
+import segmentation
+
+
+logging.basicConfig(
+    format='(%(asctime)s) [%(levelname)-8.8s] %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def reference_flood(image: np.ndarray, mask: np.ndarray, seed, tolerance: float) -> np.ndarray:
+    """
+    The original full-image dilation flood fill, kept as the baseline to compare against
+    """
+    accepted_mask: np.ndarray = np.zeros(mask.shape, dtype=np.bool_)
+    initial_color: np.ndarray = image[seed]
+    accepted_mask[*seed] = True
+
+    mask = mask.copy()
+
+    while True:
+        dilated = ndimage.binary_dilation(accepted_mask, iterations=2, mask=mask)
+        frontier = np.logical_and(dilated, np.logical_not(accepted_mask))
+
+        if frontier.sum() == 0:
+            break
+
+        coordinates = np.where(frontier == 1)
+        distance = np.linalg.norm(np.subtract(image[coordinates], initial_color), axis=1)
+
+        accepted_coordinates = np.where(distance < tolerance)[0]
+        rejected_coordinates = np.where(distance >= tolerance)[0]
+
+        if len(accepted_coordinates) == 0:
+            break
+
+        np_coordinates = np.array(coordinates)
+
+        for c in np_coordinates.T[accepted_coordinates]:
+            accepted_mask[*c] = 1
+
+        for c in np_coordinates.T[rejected_coordinates]:
+            mask[*c] = 0
+
+    return accepted_mask
+
+
+def synthetic_image(megapixels: int, block_size: int = 256, noise: float = 0.01, random_seed: int = 0) -> np.ndarray:
+    """
+    Generates a square image made of flat colored blocks with a small amount of noise
+    """
+    rng = np.random.default_rng(random_seed)
+    side = int(np.sqrt(megapixels * 1_000_000))
+    blocks = -(-side // block_size)
+
+    colors = rng.random((blocks, blocks, 3))
+    image = np.repeat(np.repeat(colors, block_size, axis=0), block_size, axis=1)[:side, :side]
+
+    return image + rng.normal(0, noise, image.shape)
+
+
+def benchmark(megapixels: int, tolerance: float = 0.05):
+    image = synthetic_image(megapixels)
+    mask = np.ones(image.shape[:2], dtype=bool)
+    seed = (image.shape[0] // 2, image.shape[1] // 2)
+
+    flood_fill = segmentation.FloodFillSegmentation(5, tolerance, silent=True)
+
+    start = datetime.datetime.now()
+    result = flood_fill.flood(image, mask, seed)
+    frontier_time = datetime.datetime.now() - start
+
+    start = datetime.datetime.now()
+    expected = reference_flood(image, mask, seed, tolerance)
+    reference_time = datetime.datetime.now() - start
+
+    logging.info("{} MP ({}x{}): frontier {}, reference {}, speedup {:.1f}x, identical: {}".format(
+        megapixels, *image.shape[:2], frontier_time, reference_time,
+        reference_time / max(frontier_time, datetime.timedelta(microseconds=1)),
+        np.array_equal(result, expected)
+    ))
+
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] if len(sys.argv) > 1 else [1, 4, 16]
+
+    for size in sizes:
+        benchmark(size)
@@ -0,0 +1,60 @@
+import logging
+import os.path
+import socket
+import sys
+
+import sam_interface
+
+
+logging.basicConfig(
+    format='(%(asctime)s) [%(levelname)-8.8s] %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def convert_backup(path: str, output_dir: str):
+    """
+    Converts a pickled segment manager backup to the compact format, keeping the image embedding if it has one
+    """
+    logging.info("Loading segment manager backup from file '{}'...".format(os.path.abspath(path)))
+    segment_manager = sam_interface.SegmentManager.load(path, load_interactive_segmentation=False)
+
+    input_size = os.path.getsize(path)
+    output_path = os.path.join(output_dir, os.path.basename(path))
+
+    # the output may replace the backup itself, so it is only moved into place once it has been completely saved
+    temp_path = "{}.{}-{}.tmp".format(output_path, socket.gethostname(), os.getpid())
+
+    try:
+        segment_manager.save(temp_path, include_embedding=True)
+        os.replace(temp_path, output_path)
+
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+    logging.info("Saved '{}' ({:.1f} MB to {:.1f} MB)".format(
+        os.path.abspath(output_path), input_size / 1024 ** 2, os.path.getsize(output_path) / 1024 ** 2
+    ))
+
+
+if __name__ == '__main__':
+    output_directory = sys.argv[1]
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    for name in sys.argv[2:]:
+        if os.path.isdir(name):
+            for child in os.listdir(name):
+                child_path = os.path.join(name, child)
+
+                if os.path.isfile(child_path) and child_path.endswith(".dat"):
+                    convert_backup(child_path, output_directory)
+
+        elif os.path.isfile(name):
+            convert_backup(name, output_directory)
+
+        else:
+            logging.error("Specified file '{}' does not exist!".format(name))
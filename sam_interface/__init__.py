@@ -2,3 +2,5 @@ import sam_interface.ui as ui
 from sam_interface.segment_manager import SegmentManager
 import sam_interface.export as export
 import sam_interface.preferences as preferences
+import sam_interface.embedding_cache as embedding_cache
+import sam_interface.model_pool as model_pool
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import typing
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+import sam_interface.preferences as preferences
+
+
+def get_image_hash(image: np.ndarray) -> str:
+    """
+    Hashes the decoded pixels of the image, so the same image saved under a different name has the same hash
+    """
+    image_hash = hashlib.sha256()
+    image_hash.update(str(image.shape).encode())
+    image_hash.update(np.ascontiguousarray(image).data)
+
+    return image_hash.hexdigest()
+
+
+def get_checkpoint_identity(checkpoint_path: str) -> typing.Optional[str]:
+    """
+    Identifies a checkpoint file by its path, size and modification time, which is much faster than hashing it
+    :return: the identity, or None if the checkpoint file cannot be read
+    """
+    checkpoint_path = os.path.abspath(checkpoint_path)
+
+    try:
+        stat = os.stat(checkpoint_path)
+
+    except OSError as e:
+        logging.warning("Cannot identify checkpoint '{}' ({}), not caching its embeddings".format(checkpoint_path, e))
+        return None
+
+    return "{}:{}:{}".format(checkpoint_path, stat.st_size, stat.st_mtime_ns)
+
+
+def get_embedding(predictor: SamPredictor) -> dict:
+    """
+    Returns the image embedding of the predictor, along with the image sizes needed to restore it
+    """
+    return dict(
+        features=predictor.features.cpu().numpy(),
+        original_size=tuple(predictor.original_size),
+        input_size=tuple(predictor.input_size)
+    )
+
+
+def set_embedding(predictor: SamPredictor, embedding: dict):
+    """
+    Loads an image embedding returned by get_embedding into the predictor, as if set_image had been called
+    """
+    predictor.reset_image()
+    predictor.features = torch.as_tensor(embedding["features"]).to(predictor.model.device)
+    predictor.original_size = tuple(int(s) for s in embedding["original_size"])
+    predictor.input_size = tuple(int(s) for s in embedding["input_size"])
+    predictor.is_image_set = True
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of SAM image embeddings, keyed by image content, model type and checkpoint. Once the total size of
+    the cache exceeds the limit, the least recently used embeddings are deleted.
+    """
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @classmethod
+    def from_preferences(cls) -> typing.Optional['EmbeddingCache']:
+        cache_prefs = preferences.get_preferences()["embedding_cache"]
+
+        if not cache_prefs["enabled"]:
+            return None
+
+        return cls(cache_prefs["directory"], int(cache_prefs["max_size_mb"] * 1024 * 1024))
+
+    @staticmethod
+    def get_key(image_hash: str, checkpoint_key: str, checkpoint_path: str) -> typing.Optional[str]:
+        """
+        :return: the key of the embedding, or None if the checkpoint cannot be identified, so it cannot be cached
+        """
+        checkpoint_identity = get_checkpoint_identity(checkpoint_path)
+
+        if checkpoint_identity is None:
+            return None
+
+        return hashlib.sha256("{}|{}|{}".format(image_hash, checkpoint_key, checkpoint_identity).encode()).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, "{}.pt".format(key))
+
+    def restore(self, predictor: SamPredictor, key: str) -> bool:
+        """
+        Loads the cached embedding into the predictor, as if set_image had been called
+        :return: True if the embedding was cached, and False otherwise
+        """
+        path = self.get_path(key)
+
+        if not os.path.isfile(path):
+            return False
+
+        try:
+            embedding = torch.load(path, map_location=predictor.model.device)
+
+        except Exception:
+            logging.warning("Discarding unreadable cached embedding '{}'".format(path))
+            os.remove(path)
+            return False
+
+        # mark the entry as recently used
+        os.utime(path)
+
+        set_embedding(predictor, embedding)
+        return True
+
+    def store(self, predictor: SamPredictor, key: str):
+        path = self.get_path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+
+        embedding = get_embedding(predictor)
+        embedding["features"] = torch.from_numpy(embedding["features"])
+
+        torch.save(embedding, temp_path)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pt"):
+                continue
+
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            logging.info("Evicting cached embedding '{}'".format(path))
+            os.remove(path)
+            total_size -= size
+
+    def set_image(self, predictor: SamPredictor, image: np.ndarray, key: str):
+        """
+        Sets the image of the predictor, only running the image encoder if the embedding is not cached
+        """
+        if self.restore(predictor, key):
+            logging.info("Restored image embedding from cache")
+            return
+
+        predictor.set_image(image)
+        self.store(predictor, key)
@@ -1,6 +1,8 @@
 import logging
 import os
 import shutil
+import socket
+import typing
 
 import numpy as np
 
@@ -10,37 +12,144 @@ import segmentation
 import vector_node
 
 
+def get_label_medians(labels: np.ndarray, image: np.ndarray) -> np.ndarray:
+    """
+    Returns the median color of the pixels with each label, computed the same way as np.median, as a
+    (max label + 1, channels) float array. Labels without any pixels have a median of 0.
+    :param labels: a (height, width) array of non-negative integer labels
+    :param image: a (height, width, channels) integer image
+    """
+    flat_labels = labels.ravel().astype(np.int64)
+    values = image.reshape(flat_labels.shape[0], -1)
+
+    counts = np.bincount(flat_labels)
+    present = np.flatnonzero(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[present]
+
+    # the positions of the middle values of each label once sorted, which are the same when the count is odd
+    low = starts + (counts[present] - 1) // 2
+    high = starts + counts[present] // 2
+
+    medians = np.zeros((counts.shape[0], values.shape[1]), dtype=np.float64)
+    value_min = np.iinfo(image.dtype).min
+    span = np.int64(np.iinfo(image.dtype).max) - value_min + 1
+
+    for channel in range(values.shape[1]):
+        # sorting label * span + value groups the pixels by label, with the values of each label in order
+        keys = np.sort(flat_labels * span + (values[:, channel].astype(np.int64) - value_min))
+        keys -= np.repeat(np.arange(counts.shape[0], dtype=np.int64) * span, counts) - value_min
+
+        medians[present, channel] = (keys[low] + keys[high]) / 2
+
+    return medians
+
+
 def to_flat_image(segment_manager: sam_interface.segment_manager.SegmentManager) -> np.ndarray:
     logging.info("Generating flat image...")
-    result = np.zeros_like(segment_manager.image)
 
-    for mask in segment_manager.masks:
-        result[mask.T] = np.median(segment_manager.image[mask.T], axis=0)
+    # every segment is painted with its median color in a single lookup, and unclaimed pixels stay black
+    colors = get_label_medians(segment_manager.labels, segment_manager.image).astype(segment_manager.image.dtype)
+    colors[0] = 0
+
+    result = colors[segment_manager.labels].reshape(segment_manager.image.shape)
 
     logging.info("Flat image ready")
     return result
 
 
 def to_mask_node(segment_manager: sam_interface.segment_manager.SegmentManager) -> vector_node.MaskNode:
-    parent = vector_node.MaskNode(np.ones(segment_manager.image.shape[:2]).astype(bool), level=0)
-    parent.filled_mask = np.ones(segment_manager.image.shape[:2]).astype(bool)
+    image = segment_manager.image
+    labels = segment_manager.labels
+
+    # the background is everything not claimed by a segment
+    background = labels == 0
 
-    for mask in segment_manager.masks:
-        parent.mask = parent.difference(mask.T)
+    parent = vector_node.MaskNode(background, color=image[background].mean(axis=0) / 255, level=0)
+    parent.filled_mask = np.ones(labels.shape, dtype=bool)
 
-        node = vector_node.MaskNode(mask.T, color=segment_manager.image[mask.T].mean(axis=0) / 255, level=1)
+    for i, (rows, columns) in enumerate(segment_manager.mask_bounding_boxes):
+        mask, origin = segment_manager.get_cropped_mask(i)
+
+        node = vector_node.MaskNode(
+            mask, color=image[rows, columns][mask].mean(axis=0) / 255, level=1, origin=origin, shape=labels.shape
+        )
         parent.add_child(node)
 
-    parent.color = segment_manager.image[parent.mask].mean(axis=0) / 255
     return parent
 
 
+# the files written for each artifact of an export, formatted with the export name
+ARTIFACT_FILES = {
+    "mask_tree": ["{}_mask_tree.dat"],
+    "vector_tree": ["{}_polygon_tree.dat", "{}_polygon.json"],
+    "raster": ["{}_polygon_raster.png"],
+    "centroids": ["{}_centroid_coordinates.npy"],
+    "detail_mask_tree": ["{}_mask_tree_detailed.dat"],
+    "detail_vector_tree": ["{}_polygon_tree_detailed.dat", "{}_polygon_detailed.json"],
+    "detail_raster": ["{}_polygon_raster_detailed.png"],
+    "image": ["{}{}"]
+}
+
+DETAIL_ARTIFACTS = ("detail_mask_tree", "detail_vector_tree", "detail_raster")
+
+
+def get_artifact_paths(export_path: str, export_name: str, artifact: str, image_ext: str = "") -> typing.List[str]:
+    """
+    Returns the paths of the files written for the artifact, where export_path is the directory passed to full_export
+    """
+    return [
+        os.path.join(export_path, export_name, template.format(export_name, image_ext))
+        for template in ARTIFACT_FILES[artifact]
+    ]
+
+
+def write_now(function: typing.Callable, path: str, *args):
+    function(path, *args)
+
+
+def write_atomic(function: typing.Callable, path: str, *args):
+    """
+    Writes the file to a temporary path in the same directory, then moves it into place, so the file at the path is
+    never partially written. The temporary path keeps the extension, since some writers use it to pick a format.
+    """
+    root, ext = os.path.splitext(path)
+    temp_path = "{}.{}-{}.tmp{}".format(root, socket.gethostname(), os.getpid(), ext)
+
+    try:
+        function(temp_path, *args)
+        os.replace(temp_path, path)
+
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+
+def write_bytes(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def copy_file(path: str, source: str):
+    shutil.copy(source, path)
+
+
 def full_export(
         segment_manager: sam_interface.segment_manager.SegmentManager, export_path: str, export_name: str,
         save_mask_tree: bool = True, save_vector_tree: bool = True, save_raster: bool = True,
         save_centroids: bool = True, save_detail_mask_tree: bool = True, save_detail_vector_tree: bool = True,
-        save_detail_raster: bool = True, min_area: int = 5, tolerance: float = 0.05
+        save_detail_raster: bool = True, min_area: int = 5, tolerance: float = 0.05, detail_workers: int = 1,
+        writer: typing.Callable = write_now, save_image: bool = True
 ):
+    """
+    :param writer: called as writer(function, path, *args) for every file to write, where function(path, *args)
+    writes the file. By default, the file is written immediately, but the call can be deferred (e.g. to a writer
+    thread), since nothing passed to the writer is modified afterwards.
+    """
+    _, file_ext = os.path.splitext(segment_manager.image_path)
+    paths = {
+        artifact: get_artifact_paths(export_path, export_name, artifact, file_ext) for artifact in ARTIFACT_FILES
+    }
+
     export_path = os.path.join(export_path, export_name)
 
     if not os.path.isdir(export_path):
@@ -50,7 +159,8 @@ def full_export(
 
     if save_mask_tree:
         logging.info("Saving mask tree...")
-        mask_tree.save(os.path.join(export_path, "{}_mask_tree.dat".format(export_name)))
+        # the mask tree is modified when getting detail, so it is serialized now in case the write is deferred
+        writer(write_bytes, paths["mask_tree"][0], mask_tree.to_bytes())
         # mask_tree.to_json_file(os.path.join(export_path, "{}_mask.json".format(export_name)))
 
     height, width, _ = segment_manager.image.shape
@@ -62,28 +172,29 @@ def full_export(
 
     if save_vector_tree:
         logging.info("Saving polygon tree...")
-        polygon_tree.save(os.path.join(export_path, "{}_polygon_tree.dat".format(export_name)))
-        polygon_tree.to_json_file(os.path.join(export_path, "{}_polygon.json".format(export_name)))
+        writer(polygon_tree.save, paths["vector_tree"][0])
+        writer(polygon_tree.to_json_file, paths["vector_tree"][1])
 
     if save_raster:
         logging.info("Saving polygon raster...")
-        polygon_tree.to_raster(os.path.join(export_path, "{}_polygon_raster.png".format(export_name)))
+        writer(polygon_tree.to_raster, paths["raster"][0])
 
     if save_centroids:
         logging.info("Saving polygon centroids...")
         centroids: np.ndarray = np.array([c.get_centroid() for c in polygon_tree.children])
-        np.save(os.path.join(export_path, "{}_centroid_coordinates.npy".format(export_name)), centroids)
+        writer(np.save, paths["centroids"][0], centroids)
 
     if save_detail_vector_tree or save_detail_mask_tree or save_detail_raster:
         logging.info("Sub-segmenting to get detail...")
         get_detail.get_detail(
             segment_manager.image / 255, mask_tree,
-            segmentation.FloodFillSegmentation(min_area, tolerance, silent=True)
+            segmentation.FloodFillSegmentation(min_area, tolerance, silent=True),
+            workers=detail_workers
         )
 
         if save_detail_mask_tree:
             logging.info("Saving detailed mask tree...")
-            mask_tree.save(os.path.join(export_path, "{}_mask_tree_detailed.dat".format(export_name)))
+            writer(mask_tree.save, paths["detail_mask_tree"][0])
             # mask_tree.to_json_file(os.path.join(export_path, "{}_mask_detailed.json".format(export_name)))
 
         height, width, _ = segment_manager.image.shape
@@ -95,15 +206,15 @@ def full_export(
 
         if save_detail_vector_tree:
             logging.info("Saving detailed polygon tree...")
-            polygon_tree.save(os.path.join(export_path, "{}_polygon_tree_detailed.dat".format(export_name)))
-            polygon_tree.to_json_file(os.path.join(export_path, "{}_polygon_detailed.json".format(export_name)))
+            writer(polygon_tree.save, paths["detail_vector_tree"][0])
+            writer(polygon_tree.to_json_file, paths["detail_vector_tree"][1])
 
         if save_detail_raster:
             logging.info("Saving detailed polygon raster...")
-            polygon_tree.to_raster(os.path.join(export_path, "{}_polygon_raster_detailed.png".format(export_name)))
+            writer(polygon_tree.to_raster, paths["detail_raster"][0])
 
-    logging.info("Copying original image to export directory...")
-    _, file_ext = os.path.splitext(segment_manager.image_path)
-    shutil.copy(segment_manager.image_path, os.path.join(export_path, "{}{}".format(export_name, file_ext)))
+    if save_image:
+        logging.info("Copying original image to export directory...")
+        writer(copy_file, paths["image"][0], segment_manager.image_path)
 
     logging.info("Export complete")
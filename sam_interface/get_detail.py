@@ -1,19 +1,130 @@
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import typing
+
 import numpy as np
 import tqdm
 
 import vector_node
 import segmentation
+import segmentation.base_segmentation as base_segmentation
+
+# state of each worker process in the parallel pool, set by _init_worker
+_worker_state = {}
+
+
+def get_child_detail(
+        image: np.ndarray, mask: np.ndarray, segmentation_method: segmentation.BaseSegmentation, margin: int = 1,
+        origin: tuple = (0, 0)
+) -> typing.Tuple[typing.List[typing.Tuple[np.ndarray, tuple, np.ndarray]], typing.Optional[np.ndarray]]:
+    """
+    Sub-segments the area of the image covered by the mask
+    :param origin: the (row, column) offset of the mask in the image, if the mask is cropped
+    :return: a list of (cropped mask, offset, color) for each sub-segment, and the color of the pixels not covered by
+    any sub-segment (None if there are no such pixels)
+    """
+    rows, columns = base_segmentation.get_cropped_bounding_box(mask, origin, image.shape[:2], margin)
+    image_crop = image[rows, columns]
+
+    remaining_mask = base_segmentation.realign_mask(mask, origin, (rows.start, columns.start), image_crop.shape[:2])
+
+    children, _ = segmentation_method.segment_cropped_with_remainder(
+        image, mask, margin=margin, mask_origin=origin
+    )
+
+    result = []
+    for c, c_origin in children:
+        c_rows = slice(c_origin[0], c_origin[0] + c.shape[0])
+        c_columns = slice(c_origin[1], c_origin[1] + c.shape[1])
+
+        result.append((c, c_origin, np.median(image[c_rows, c_columns][c], axis=0)))
+
+        # each sub-segment is cropped to its own bounding box, which lies within the segmented box
+        remaining_box = (
+            slice(c_rows.start - rows.start, c_rows.stop - rows.start),
+            slice(c_columns.start - columns.start, c_columns.stop - columns.start)
+        )
+        remaining_mask[remaining_box] = np.logical_and(remaining_mask[remaining_box], np.logical_not(c))
+
+    if remaining_mask.sum() > 0:
+        return result, np.median(image_crop[remaining_mask], axis=0)
+
+    return result, None
+
+
+def _init_worker(
+        shared_memory_name: str, shape: tuple, dtype: np.dtype,
+        segmentation_method: segmentation.BaseSegmentation, margin: int
+):
+    shared_memory = multiprocessing.shared_memory.SharedMemory(name=shared_memory_name)
+
+    _worker_state["shared_memory"] = shared_memory
+    _worker_state["image"] = np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+    _worker_state["segmentation_method"] = segmentation_method
+    _worker_state["margin"] = margin
+
+
+def _get_child_detail_worker(task: typing.Tuple[np.ndarray, tuple]):
+    mask, origin = task
+
+    return get_child_detail(
+        _worker_state["image"], mask, _worker_state["segmentation_method"], _worker_state["margin"], origin
+    )
+
+
+def _get_detail_parallel(
+        image: np.ndarray, parent: vector_node.MaskNode, segmentation_method: segmentation.BaseSegmentation,
+        margin: int, workers: int
+) -> typing.Iterable:
+    # only the crop of each child mask is sent to the workers, the image itself is shared
+    tasks = [(child.cropped_mask, child.origin) for child in parent.children]
+
+    shared_memory = multiprocessing.shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+
+    try:
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shared_memory.buf)[:] = image
+
+        # callers export from threads, and forking a process with other threads running (e.g. holding torch or
+        # logging locks) can deadlock the workers, so they are started fresh. They receive everything through initargs.
+        with multiprocessing.get_context("spawn").Pool(
+                workers, initializer=_init_worker,
+                initargs=(shared_memory.name, image.shape, image.dtype, segmentation_method, margin)
+        ) as pool:
+            # imap returns results in the order of the children, regardless of which worker finishes first
+            yield from pool.imap(_get_child_detail_worker, tasks)
+
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def get_detail(
+        image: np.ndarray, parent: vector_node.MaskNode, segmentation_method: segmentation.BaseSegmentation,
+        margin: int = 1, workers: int = 1
+):
+    """
+    Sub-segments each child of the parent, adding the sub-segments as children of each child
+    :param workers: the number of processes to sub-segment with. 1 runs in this process, and 0 uses every CPU core
+    """
+    shape = image.shape[:2]
 
+    if workers == 0:
+        workers = os.cpu_count()
 
-def get_detail(image: np.ndarray, parent: vector_node.MaskNode, segmentation_method: segmentation.BaseSegmentation):
-    for child in tqdm.tqdm(parent.children):
-        remaining_mask = child.mask.copy()
+    if workers > 1:
+        details = _get_detail_parallel(image, parent, segmentation_method, margin, workers)
 
-        children, _ = segmentation_method.segment_with_remainder(image, child.mask)
+    else:
+        details = (
+            get_child_detail(image, child.cropped_mask, segmentation_method, margin, child.origin)
+            for child in parent.children
+        )
 
-        for c in children:
-            child.children.append(vector_node.MaskNode(c, color=np.median(image[c], axis=0)))
-            remaining_mask = np.logical_and(remaining_mask, np.logical_not(c))
+    for (children, color), child in tqdm.tqdm(zip(details, parent.children), total=len(parent.children)):
+        # sub-segments are kept cropped to their bounding boxes
+        for c, origin, c_color in children:
+            child.children.append(vector_node.MaskNode(c, color=c_color, origin=origin, shape=shape))
 
-        if remaining_mask.sum() > 0:
-            child.color = np.median(image[remaining_mask], axis=0)
+        if color is not None:
+            child.color = color
@@ -0,0 +1,201 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    file_hash = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def normalize_settings(settings: dict) -> dict:
+    """
+    Converts the settings to the form they take once written to and read back from JSON, so they can be compared
+    """
+    return json.loads(json.dumps(settings))
+
+
+class Manifest:
+    """
+    Records which artifacts of each export are complete, along with the hash of the input and the settings each
+    artifact was created with, so reruns only redo the missing or out of date artifacts
+    """
+    def __init__(self, path: str, lock_timeout: float = 60):
+        """
+        :param lock_timeout: the number of seconds after which a lock on the manifest file left by another process is
+        assumed to be abandoned
+        """
+        self.path = path
+        self.lock_path = "{}.lock".format(path)
+        self.lock_timeout = lock_timeout
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.loaded_mtime = None
+
+        self._reload()
+
+    def _reload(self):
+        """
+        Reads the manifest again if it was changed since it was last read (e.g. by another process)
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+
+        except FileNotFoundError:
+            return
+
+        if mtime == self.loaded_mtime:
+            return
+
+        with open(self.path) as f:
+            loaded = json.loads(f.read())
+
+        self.loaded_mtime = mtime
+
+        if loaded.get("version") == MANIFEST_VERSION:
+            self.entries = loaded["entries"]
+
+        else:
+            logging.warning("Ignoring manifest '{}' with unsupported version".format(os.path.abspath(self.path)))
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """
+        Prevents other processes from updating the manifest. Creating the lock file is atomic, even on most network
+        filesystems.
+        """
+        while True:
+            try:
+                os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+
+            except FileExistsError:
+                self._remove_abandoned_lock()
+                time.sleep(0.1)
+
+        try:
+            yield
+
+        finally:
+            os.remove(self.lock_path)
+
+    def _remove_abandoned_lock(self):
+        """
+        Removes the lock file if it is older than the lock timeout. The lock is first moved to a name of its own, so
+        only one waiter removes it, and is only removed if it is still the file which was found to be abandoned. A new
+        lock taken by another waiter in the meantime is put back.
+        """
+        try:
+            lock_stat = os.stat(self.lock_path)
+
+        except FileNotFoundError:
+            return
+
+        if time.time() - lock_stat.st_mtime <= self.lock_timeout:
+            return
+
+        claimed_path = "{}.{}-{}.stale".format(self.lock_path, socket.gethostname(), os.getpid())
+
+        try:
+            os.rename(self.lock_path, claimed_path)
+            claimed_stat = os.stat(claimed_path)
+
+        except FileNotFoundError:
+            # removed or claimed by another waiter first
+            return
+
+        # inodes can be reused as soon as a file is removed, so the modification time is compared too
+        if (claimed_stat.st_dev, claimed_stat.st_ino, claimed_stat.st_mtime_ns) != (
+                lock_stat.st_dev, lock_stat.st_ino, lock_stat.st_mtime_ns
+        ):
+            try:
+                os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+            except FileExistsError:
+                pass
+
+        else:
+            logging.warning("Removing abandoned manifest lock '{}'".format(self.lock_path))
+
+        os.remove(claimed_path)
+
+    def get_stale_artifacts(self, export_name: str, input_hash: str, settings: typing.Dict[str, dict]) -> set:
+        """
+        Returns the artifacts which need to be created again, since the input has changed, they were created with
+        different settings, or any of their files are missing
+        :param settings: the settings each artifact would be created with, keyed by artifact
+        """
+        with self.lock:
+            self._reload()
+            entry = self.entries.get(export_name)
+
+            if entry is None or entry["input_hash"] != input_hash:
+                return set(settings)
+
+            stale = set()
+            for artifact, artifact_settings in settings.items():
+                record = entry["artifacts"].get(artifact)
+
+                if (
+                        record is None or record["settings"] != normalize_settings(artifact_settings) or
+                        not all(os.path.isfile(f) for f in record["files"])
+                ):
+                    stale.add(artifact)
+
+            return stale
+
+    def get_entry(self, export_name: str) -> typing.Optional[dict]:
+        with self.lock:
+            self._reload()
+            entry = self.entries.get(export_name)
+            return None if entry is None else json.loads(json.dumps(entry))
+
+    def record(
+            self, export_name: str, input_path: str, input_hash: str,
+            artifacts: typing.Dict[str, typing.Tuple[dict, typing.List[str]]]
+    ):
+        """
+        Marks the artifacts as complete and saves the manifest
+        :param artifacts: the settings and the list of written files of each artifact, keyed by artifact
+        """
+        with self.lock, self._file_lock():
+            self._reload()
+            entry = self.entries.get(export_name)
+
+            if entry is None or entry["input_hash"] != input_hash:
+                entry = dict(input_hash=input_hash, artifacts={})
+                self.entries[export_name] = entry
+
+            entry["input_path"] = os.path.abspath(input_path)
+            entry["updated"] = datetime.datetime.now().isoformat()
+
+            for artifact, (settings, files) in artifacts.items():
+                entry["artifacts"][artifact] = dict(
+                    settings=normalize_settings(settings), files=[os.path.abspath(f) for f in files]
+                )
+
+            self._save()
+
+    def _save(self):
+        temp_path = "{}.{}-{}.tmp".format(self.path, socket.gethostname(), os.getpid())
+
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(dict(version=MANIFEST_VERSION, entries=self.entries), indent=4))
+
+        os.replace(temp_path, self.path)
+        self.loaded_mtime = os.stat(self.path).st_mtime_ns
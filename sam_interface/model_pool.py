@@ -0,0 +1,96 @@
+import collections
+import logging
+import os
+import threading
+import typing
+
+import torch
+from segment_anything import sam_model_registry
+
+import sam_interface.preferences as preferences
+
+# loaded models keyed by (model type, absolute checkpoint path), ordered from least to most recently used
+_models: typing.OrderedDict[typing.Tuple[str, str], torch.nn.Module] = collections.OrderedDict()
+_model_sizes: typing.Dict[typing.Tuple[str, str], int] = {}
+_lock = threading.Lock()
+
+
+def get_model_size(model: torch.nn.Module) -> int:
+    """
+    Returns the number of bytes used by the parameters and buffers of the model
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def get_model(model_type: str, checkpoint_path: str) -> torch.nn.Module:
+    """
+    Returns the SAM model for the model type and checkpoint, only loading it the first time it is requested in this
+    process
+    """
+    key = (model_type, os.path.abspath(checkpoint_path))
+
+    with _lock:
+        if key in _models:
+            _models.move_to_end(key)
+            return _models[key]
+
+        logging.info("Loading SAM model from checkpoint '{}'...".format(key[1]))
+        model = sam_model_registry[model_type](checkpoint=checkpoint_path)
+
+        _models[key] = model
+        _model_sizes[key] = get_model_size(model)
+
+        logging.info("Loaded {} model ({:.1f} MB). {} model(s) loaded using {:.1f} MB.".format(
+            model_type, _model_sizes[key] / 1024 ** 2, len(_models), get_memory_usage() / 1024 ** 2
+        ))
+
+        _evict(keep=key)
+        return model
+
+
+def _evict(keep: typing.Tuple[str, str]):
+    # models are unloaded, least recently used first, once the total size exceeds the limit
+    max_memory_mb = preferences.get_preferences()["max_model_memory_mb"]
+
+    if max_memory_mb is None:
+        return
+
+    for key in list(_models):
+        if get_memory_usage() <= max_memory_mb * 1024 ** 2:
+            break
+
+        if key == keep:
+            continue
+
+        logging.info("Unloading {} model '{}' to free memory".format(*key))
+        del _models[key]
+        del _model_sizes[key]
+
+
+def get_memory_usage() -> int:
+    """
+    Returns the total number of bytes used by every loaded model
+    """
+    return sum(_model_sizes.values())
+
+
+def get_loaded_models() -> typing.Dict[typing.Tuple[str, str], int]:
+    """
+    Returns the size in bytes of each loaded model, keyed by (model type, absolute checkpoint path)
+    """
+    with _lock:
+        return dict(_model_sizes)
+
+
+def release(model_type: str, checkpoint_path: str):
+    with _lock:
+        key = (model_type, os.path.abspath(checkpoint_path))
+        _models.pop(key, None)
+        _model_sizes.pop(key, None)
+
+
+def clear():
+    with _lock:
+        _models.clear()
+        _model_sizes.clear()
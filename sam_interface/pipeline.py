@@ -0,0 +1,96 @@
+import logging
+import queue
+import threading
+import typing
+
+# placed on a queue once for every worker of the next stage when there are no more items
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name: str, function: typing.Callable, workers: int = 1, queue_size: int = 2):
+        """
+        :param function: called with each item and returns the item to pass to the next stage, or None to drop it
+        :param workers: the number of threads running this stage
+        :param queue_size: the maximum number of items waiting for this stage. Earlier stages block once it is full.
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+
+
+def run_pipeline(
+        items: typing.Iterable, stages: typing.List[Stage],
+        on_finish: typing.Callable[[typing.Any, typing.Optional[Exception]], None] = None
+):
+    """
+    Passes each item through every stage in order. Each stage runs in its own threads with a bounded queue in front of
+    it, so different items can be in different stages at the same time. If a stage raises an exception for an item,
+    the error is logged and the item is dropped.
+    :param on_finish: called with each item as it leaves the pipeline, either after the last stage or when it is
+    dropped, along with the exception which dropped it, if any. The item is the one passed to the stage it left from.
+    """
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+    remaining_workers = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def finish_stage(index: int):
+        with lock:
+            remaining_workers[index] -= 1
+            finished = remaining_workers[index] == 0
+
+        if finished and index + 1 < len(stages):
+            for _ in range(stages[index + 1].workers):
+                queues[index + 1].put(_DONE)
+
+    def finish_item(item, error: typing.Optional[Exception]):
+        if on_finish is None:
+            return
+
+        try:
+            on_finish(item, error)
+
+        except Exception:
+            logging.exception("Failed to finish pipeline item")
+
+    def run_stage(index: int):
+        stage = stages[index]
+
+        while True:
+            item = queues[index].get()
+
+            if item is _DONE:
+                break
+
+            try:
+                result = stage.function(item)
+
+            except Exception as e:
+                logging.exception("Pipeline stage '{}' failed".format(stage.name))
+                finish_item(item, e)
+                continue
+
+            if result is not None and index + 1 < len(stages):
+                queues[index + 1].put(result)
+
+            else:
+                finish_item(item if result is None else result, None)
+
+        finish_stage(index)
+
+    threads = []
+    for i, stage in enumerate(stages):
+        for j in range(stage.workers):
+            thread = threading.Thread(target=run_stage, args=[i], name="{}-{}".format(stage.name, j), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    for item in items:
+        queues[0].put(item)
+
+    for _ in range(stages[0].workers):
+        queues[0].put(_DONE)
+
+    for thread in threads:
+        thread.join()
@@ -20,9 +20,27 @@ DEFAULT_PREFERENCES = {
         "save_detail_vector_tree": True,
         "save_detail_raster": True,
         "min_area": 5,
-        "tolerance": 0.05
+        "tolerance": 0.05,
+        "detail_workers": 1
     },
-    "min_sam_segment": 10
+    "min_sam_segment": 10,
+    "max_model_memory_mb": None,
+    "batch_pipeline": {
+        "load_workers": 2,
+        "segment_workers": 1,
+        "export_workers": 2,
+        "write_workers": 2,
+        "queue_size": 2
+    },
+    "batch_spool": {
+        "lease_timeout": 600,
+        "poll_interval": 5
+    },
+    "embedding_cache": {
+        "enabled": True,
+        "directory": "embedding_cache",
+        "max_size_mb": 1024
+    }
 }
 
 
@@ -1,3 +1,4 @@
+import bisect
 import os.path
 import pickle
 import typing
@@ -7,42 +8,74 @@ import pygame
 import shapely
 import torch
 import logging
-from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
+from segment_anything import SamPredictor, SamAutomaticMaskGenerator
 from scipy.ndimage import label
+import sam_interface.embedding_cache as embedding_cache
+import sam_interface.model_pool as model_pool
 import sam_interface.preferences as preferences
+import segmentation.base_segmentation as base_segmentation
 import cv2
 
+SAVE_FORMAT = "sam_interface.segment_manager"
+SAVE_FORMAT_VERSION = 1
+
+# backups are numpy .npz archives, older backups are pickles
+ZIP_MAGIC = b"PK\x03\x04"
+
+
+class MaskView(typing.Sequence[np.ndarray]):
+    """
+    Read only view of the segments of a segment manager as full resolution (width, height) boolean masks, which are
+    only materialized when accessed
+    """
+    def __init__(self, segment_manager: 'SegmentManager'):
+        self.segment_manager = segment_manager
+
+    def __len__(self) -> int:
+        return len(self.segment_manager.mask_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return self.segment_manager.get_mask(index)
+
 
 class SegmentManager:
     def __init__(
             self, image_path: str, checkpoint_key: str = "default",
             checkpoint_path: str = "checkpoints/sam_vit_h_4b8939.pth",
-            auto_detect_masks: bool = True, load_interactive_segmentation: bool = True
+            auto_detect_masks: bool = True, load_interactive_segmentation: bool = True,
+            sam: torch.nn.Module = None
     ):
+        """
+        :param sam: an already loaded SAM model to use. If not specified, the model for the checkpoint is taken from
+        the process-wide model pool, which only loads each checkpoint once.
+        """
         self.checkpoint_key = checkpoint_key
         self.checkpoint_path = checkpoint_path
         self.image_path = image_path
 
-        self.masks = []
-        self.mask_outlines = []
+        self.image = self.read_image(self.image_path)
+        self.image_hash = embedding_cache.get_image_hash(self.image)
 
-        logging.info("Reading image '{}' into memory...".format(os.path.abspath(self.image_path)))
-        self.image = cv2.imread(self.image_path)
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+        # each segment is stored as a unique id in a single label map (0 is unclaimed), with its metadata stored in
+        # the following lists in the order the segments were added
+        self.labels: np.ndarray = np.zeros(self.image.shape[:2], dtype=np.int32)
+        self.next_mask_id = 1
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        logging.info("Detecting if CUDA is installed...")
-        if torch.cuda.is_available():
-            logging.info("CUDA detected. Using GPU {}.".format(torch.cuda.get_device_name(torch.cuda.current_device())))
-            self.device = "cuda"
+        self.mask_ids = []
+        self.mask_bounding_boxes = []
+        self.mask_areas = []
+        self.mask_outlines = []
 
-        else:
-            logging.warning("CUDA not enabled! Using CPU instead. This will result in longer processing times.")
-            self.device = "cpu"
+        self.device = self.get_device()
 
-        logging.info("Loading SAM model from checkpoint '{}'...".format(os.path.abspath(checkpoint_path)))
-        self.sam = self.get_sam()
+        # the model and predictor are only loaded when first needed
+        self.load_interactive_segmentation = load_interactive_segmentation
+        self._sam = sam
+        self._predictor = None
+        self._saved_embedding = None
 
         if auto_detect_masks:
             logging.info("Automatically detecting segments...")
@@ -54,26 +87,251 @@ class SegmentManager:
             logging.info("Skipping automatic segment detection")
 
         if load_interactive_segmentation:
-            self.sam.to(device=self.device)
+            self.attach_predictor()
 
-            logging.info("Loading image into SAM predictor...")
-            self.predictor = SamPredictor(self.sam)
-            self.predictor.set_image(self.image)
+    @staticmethod
+    def read_image(image_path: str) -> np.ndarray:
+        logging.info("Reading image '{}' into memory...".format(os.path.abspath(image_path)))
+        image = cv2.imread(image_path)
 
-        else:
-            self.predictor = None
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    @staticmethod
+    def get_device() -> str:
+        logging.info("Detecting if CUDA is installed...")
+        if torch.cuda.is_available():
+            logging.info("CUDA detected. Using GPU {}.".format(torch.cuda.get_device_name(torch.cuda.current_device())))
+            return "cuda"
+
+        logging.warning("CUDA not enabled! Using CPU instead. This will result in longer processing times.")
+        return "cpu"
 
     def get_sam(self):
-        return sam_model_registry[self.checkpoint_key](checkpoint=self.checkpoint_path)
+        return model_pool.get_model(self.checkpoint_key, self.checkpoint_path)
+
+    @property
+    def sam(self):
+        if self._sam is None:
+            self._sam = self.get_sam()
+
+        return self._sam
+
+    @property
+    def predictor(self) -> typing.Optional[SamPredictor]:
+        if self._predictor is None and self.load_interactive_segmentation:
+            self.attach_predictor()
+
+        return self._predictor
+
+    def attach_predictor(self):
+        if self._predictor is not None:
+            return
+
+        self.sam.to(device=self.device)
+
+        logging.info("Loading image into SAM predictor...")
+        self._predictor = SamPredictor(self.sam)
+
+        if self._saved_embedding is not None:
+            embedding_cache.set_embedding(self._predictor, self._saved_embedding)
+            self._saved_embedding = None
+
+        else:
+            self.set_predictor_image()
+
+    def set_predictor_image(self):
+        cache = embedding_cache.EmbeddingCache.from_preferences()
+        key = None if cache is None else cache.get_key(self.image_hash, self.checkpoint_key, self.checkpoint_path)
+
+        if key is None:
+            self._predictor.set_image(self.image)
+            return
+
+        cache.set_image(self._predictor, self.image, key)
 
     @classmethod
-    def load(cls, path: str) -> typing.Self:
+    def load(cls, path: str, load_interactive_segmentation: bool = True, sam: torch.nn.Module = None) -> typing.Self:
+        """
+        Loads a segment manager saved with save. Backups pickled by older versions are also supported.
+        :param load_interactive_segmentation: if True, the model is loaded from the saved checkpoint and attached
+        immediately. Otherwise, it is only loaded if interactive segmentation is used.
+        :param sam: an already loaded SAM model to use instead of the model pool
+        """
         with open(path, 'rb') as f:
-            return pickle.loads(f.read())
+            if f.read(len(ZIP_MAGIC)) != ZIP_MAGIC:
+                f.seek(0)
+                segment_manager = pickle.loads(f.read())
+
+                if sam is not None:
+                    segment_manager._sam = sam
+
+                return segment_manager
+
+            f.seek(0)
+            with np.load(f) as data:
+                data = dict(data)
+
+        version = int(data["version"])
+
+        if str(data["format"]) != SAVE_FORMAT or version > SAVE_FORMAT_VERSION:
+            raise ValueError("File '{}' is not a supported segment manager backup (version {})".format(path, version))
+
+        segment_manager = cls.__new__(cls)
+        segment_manager.checkpoint_key = str(data["checkpoint_key"])
+        segment_manager.checkpoint_path = str(data["checkpoint_path"])
+        segment_manager.image_path = str(data["image_path"])
+
+        if not os.path.isfile(segment_manager.image_path):
+            # fall back to an image with the same name next to the backup, in case both were moved together
+            local_path = os.path.join(os.path.dirname(path), os.path.basename(segment_manager.image_path))
+
+            if os.path.isfile(local_path):
+                segment_manager.image_path = local_path
+
+        segment_manager.image = cls.read_image(segment_manager.image_path)
+        segment_manager.image_hash = embedding_cache.get_image_hash(segment_manager.image)
+
+        if segment_manager.image_hash != str(data["image_hash"]):
+            logging.warning("Image '{}' has changed since the segmentation was saved!".format(
+                os.path.abspath(segment_manager.image_path)
+            ))
+
+        segment_manager.labels = data["labels"]
+        segment_manager.next_mask_id = int(data["next_mask_id"])
+
+        segment_manager.mask_ids = data["mask_ids"].tolist()
+        segment_manager.mask_bounding_boxes = [
+            (slice(top, bottom), slice(left, right)) for top, bottom, left, right in data["mask_bounding_boxes"].tolist()
+        ]
+        segment_manager.mask_areas = data["mask_areas"].tolist()
+        segment_manager.mask_outlines = []
+
+        if len(data["mask_outline_lengths"]) > 0:
+            segment_manager.mask_outlines = np.split(
+                data["mask_outlines"], np.cumsum(data["mask_outline_lengths"])[:-1]
+            )
+
+        segment_manager.device = cls.get_device()
+        segment_manager.load_interactive_segmentation = load_interactive_segmentation
+        segment_manager._sam = sam
+        segment_manager._predictor = None
+        segment_manager._saved_embedding = None
+
+        if "embedding_features" in data:
+            segment_manager._saved_embedding = dict(
+                features=data["embedding_features"],
+                original_size=data["embedding_original_size"],
+                input_size=data["embedding_input_size"]
+            )
+
+        if load_interactive_segmentation:
+            segment_manager.attach_predictor()
+
+        return segment_manager
+
+    def save(self, path: str, include_embedding: bool = False):
+        """
+        Saves the segmentation without the model or the image. The image is read back from its original path on load.
+        :param include_embedding: if True, the image embedding of the predictor is also saved, so the image encoder
+        does not need to be run again on load
+        """
+        data = dict(
+            format=np.array(SAVE_FORMAT),
+            version=np.array(SAVE_FORMAT_VERSION),
+            checkpoint_key=np.array(self.checkpoint_key),
+            checkpoint_path=np.array(self.checkpoint_path),
+            image_path=np.array(os.path.abspath(self.image_path)),
+            image_hash=np.array(self.image_hash),
+            labels=self.labels,
+            next_mask_id=np.array(self.next_mask_id),
+            mask_ids=np.array(self.mask_ids, dtype=np.int32),
+            mask_bounding_boxes=np.array([
+                (rows.start, rows.stop, columns.start, columns.stop) for rows, columns in self.mask_bounding_boxes
+            ], dtype=np.int64).reshape(-1, 4),
+            mask_areas=np.array(self.mask_areas, dtype=np.int64),
+            mask_outline_lengths=np.array([len(o) for o in self.mask_outlines], dtype=np.int64),
+            mask_outlines=np.concatenate(self.mask_outlines).astype(np.int32) if self.mask_outlines else np.zeros(
+                (0, 2), dtype=np.int32
+            )
+        )
+
+        embedding = self.get_embedding() if include_embedding else None
+
+        if embedding is not None:
+            data["embedding_features"] = np.asarray(embedding["features"])
+            data["embedding_original_size"] = np.array(embedding["original_size"])
+            data["embedding_input_size"] = np.array(embedding["input_size"])
 
-    def save(self, path: str):
         with open(path, 'wb') as f:
-            f.write(pickle.dumps(self))
+            np.savez_compressed(f, **data)
+
+    def get_embedding(self) -> typing.Optional[dict]:
+        if self._predictor is not None and self._predictor.is_image_set:
+            return embedding_cache.get_embedding(self._predictor)
+
+        return self._saved_embedding
+
+    def __setstate__(self, state: dict):
+        # backups pickled by older versions include the model and predictor, which are now loaded lazily
+        if "sam" in state:
+            state["_sam"] = state.pop("sam")
+            state["_predictor"] = state.pop("predictor", None)
+            state["_saved_embedding"] = None
+            state["load_interactive_segmentation"] = state["_predictor"] is not None
+
+        if "labels" not in state:
+            # backups made before the label map was introduced store a list of full resolution masks
+            masks = state.pop("masks")
+            labels = np.zeros(state["image"].shape[:2], dtype=np.int32)
+
+            state["mask_ids"] = []
+            state["mask_bounding_boxes"] = []
+            state["mask_areas"] = []
+
+            for i, mask in enumerate(masks):
+                mask = mask.T
+                labels[mask] = i + 1
+
+                state["mask_ids"].append(i + 1)
+                state["mask_bounding_boxes"].append(base_segmentation.get_bounding_box(mask))
+                state["mask_areas"].append(int(mask.sum()))
+
+            state["labels"] = labels
+            state["next_mask_id"] = len(masks) + 1
+
+        if "image_hash" not in state:
+            state["image_hash"] = embedding_cache.get_image_hash(state["image"])
+
+        self.__dict__.update(state)
+
+    @property
+    def masks(self) -> MaskView:
+        return MaskView(self)
+
+    def get_mask(self, index: int) -> np.ndarray:
+        """
+        Returns the full resolution (width, height) boolean mask of the segment at the specified index
+        """
+        mask, (row, column) = self.get_cropped_mask(index)
+        return base_segmentation.paste_mask(mask, (row, column), self.labels.shape).T
+
+    def get_cropped_mask(self, index: int) -> typing.Tuple[np.ndarray, typing.Tuple[int, int]]:
+        """
+        Returns the (height, width) boolean mask of the segment at the specified index, cropped to its bounding box,
+        along with the (row, column) offset of the bounding box
+        """
+        rows, columns = self.mask_bounding_boxes[index]
+        return self.labels[rows, columns] == self.mask_ids[index], (rows.start, columns.start)
+
+    def remove_mask(self, index: int):
+        rows, columns = self.mask_bounding_boxes[index]
+        crop = self.labels[rows, columns]
+        crop[crop == self.mask_ids[index]] = 0
+
+        del self.mask_ids[index]
+        del self.mask_bounding_boxes[index]
+        del self.mask_areas[index]
+        del self.mask_outlines[index]
 
     def auto_detect_masks(self):
         mask_generator = SamAutomaticMaskGenerator(self.sam)
@@ -83,18 +341,24 @@ class SegmentManager:
             self.add_mask(mask["segmentation"])
 
     def add_mask(self, mask: np.ndarray) -> bool:
-        mask = mask.T
-
         if (mask[:5, :].sum() > 1 and mask[-5:, :].sum() > 1) or (mask[:, :5].sum() > 1 and mask[:, -5:].sum() > 1):
             return False
 
-        for other in self.masks:
-            mask = np.logical_and(mask, np.logical_not(other))
+        # only unclaimed pixels within the bounding box of the mask are considered
+        rows, columns = base_segmentation.get_bounding_box(mask)
+        mask = np.logical_and(mask[rows, columns], self.labels[rows, columns] == 0)
+
+        area = int(np.sum(mask))
 
-        if np.sum(mask) < preferences.get_preferences()["min_sam_segment"]:
+        if area == 0 or area < preferences.get_preferences()["min_sam_segment"]:
             return False
 
-        surf = pygame.pixelcopy.make_surface(mask.astype(int) * 255)
+        inner_rows, inner_columns = base_segmentation.get_bounding_box(mask)
+        mask = mask[inner_rows, inner_columns]
+        rows = slice(rows.start + inner_rows.start, rows.start + inner_rows.stop)
+        columns = slice(columns.start + inner_columns.start, columns.start + inner_columns.stop)
+
+        surf = pygame.pixelcopy.make_surface(mask.T.astype(int) * 255)
         surf.set_colorkey((0, 0, 0))
 
         pg_mask = pygame.mask.from_surface(surf)
@@ -108,8 +372,16 @@ class SegmentManager:
         if polygon.area < 10:
             return False
 
-        self.masks.append(mask)
-        self.mask_outlines.append(np.array(outline))
+        mask_id = self.next_mask_id
+        self.next_mask_id += 1
+
+        crop = self.labels[rows, columns]
+        crop[mask] = mask_id
+
+        self.mask_ids.append(mask_id)
+        self.mask_bounding_boxes.append((rows, columns))
+        self.mask_areas.append(area)
+        self.mask_outlines.append(np.array(outline) + (columns.start, rows.start))
 
         return True
 
@@ -134,18 +406,16 @@ class SegmentManager:
             self.add_mask(labeled_mask == feature)
 
     def remove_point(self, point):
-        removal = []
-        for i, mask in enumerate(self.masks):
-            surf = pygame.pixelcopy.make_surface(mask.astype(int) * 255)
-            surf.set_colorkey((0, 0, 0))
+        column, row = int(point[0]), int(point[1])
+        height, width = self.labels.shape
 
-            mask = pygame.mask.from_surface(surf)
+        if not (0 <= row < height and 0 <= column < width):
+            return
 
-            if mask.get_at(point):
-                removal.append(i)
+        mask_id = self.labels[row, column]
 
-        removal.reverse()
+        if mask_id == 0:
+            return
 
-        for i in removal:
-            del self.masks[i]
-            del self.mask_outlines[i]
+        # ids are assigned in increasing order and never reordered, so the list of ids is always sorted
+        self.remove_mask(bisect.bisect_left(self.mask_ids, mask_id))
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import typing
+import uuid
+
+PENDING_DIR = "pending"
+LEASED_DIR = "leased"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+
+# entries are named by enqueue, and leased entries add the claim time in milliseconds and the worker's id. Other files
+# (e.g. editor swap files) are ignored.
+ENTRY_PATTERN = re.compile(r"^\d{14}-[0-9a-f]{32}\.json$")
+LEASE_PATTERN = re.compile(r"^(?P<name>\d{14}-[0-9a-f]{32}\.json)\.(?P<claim_time>\d+)\.(?P<worker_id>.+)$")
+
+
+class Lease:
+    def __init__(self, name: str, leased_path: str, data: dict):
+        self.name = name
+        self.leased_path = leased_path
+        self.data = data
+
+    @property
+    def path(self) -> str:
+        return self.data["path"]
+
+
+class Spool:
+    """
+    Queue of files to convert stored in a directory, which any number of worker processes (on any number of hosts
+    sharing the filesystem) can claim files from. Each file has a JSON entry which moves between the pending, leased,
+    done and failed subdirectories. Entries are only ever moved with renames, which are atomic, so each entry is
+    claimed by one worker at a time.
+
+    A claimed entry is renamed to include the time it was claimed and the worker's id, and its modification time is
+    refreshed by the worker while it is being processed. If a worker stops refreshing an entry for longer than the
+    lease timeout (e.g. it crashed), the entry is moved back to pending by the next worker to look for work. The claim
+    time is part of the name, since a renamed entry keeps the modification time from when it was enqueued until the
+    claiming worker first refreshes it.
+    """
+    def __init__(self, directory: str, lease_timeout: float = 600):
+        self.directory = directory
+        self.lease_timeout = lease_timeout
+        self.worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+
+        self.active_leases: typing.Dict[str, Lease] = {}
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+
+        for subdirectory in (PENDING_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR):
+            os.makedirs(os.path.join(self.directory, subdirectory), exist_ok=True)
+
+    def get_path(self, subdirectory: str, name: str) -> str:
+        return os.path.join(self.directory, subdirectory, name)
+
+    def enqueue(self, path: str) -> str:
+        name = "{}-{}.json".format(time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex)
+        temp_path = os.path.join(self.directory, "{}.tmp".format(name))
+
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(dict(path=os.path.abspath(path))))
+
+        os.replace(temp_path, self.get_path(PENDING_DIR, name))
+        return name
+
+    def claim(self) -> typing.Optional[Lease]:
+        self.requeue_expired()
+
+        for name in sorted(self.get_entries(PENDING_DIR)):
+            leased_path = self.get_path(LEASED_DIR, "{}.{}.{}".format(name, int(time.time() * 1000), self.worker_id))
+
+            try:
+                os.rename(self.get_path(PENDING_DIR, name), leased_path)
+
+            except FileNotFoundError:
+                # claimed by another worker first
+                continue
+
+            try:
+                os.utime(leased_path)
+
+                with open(leased_path) as f:
+                    lease = Lease(name, leased_path, json.loads(f.read()))
+
+            except FileNotFoundError:
+                logging.warning("Lease '{}' was lost as soon as it was claimed".format(name))
+                continue
+
+            with self.lock:
+                self.active_leases[name] = lease
+
+            return lease
+
+        return None
+
+    def requeue_expired(self):
+        now = time.time()
+
+        for leased_name in self.get_entries(LEASED_DIR):
+            leased_path = self.get_path(LEASED_DIR, leased_name)
+            lease_match = LEASE_PATTERN.match(leased_name)
+
+            try:
+                last_renewed = max(os.stat(leased_path).st_mtime, int(lease_match["claim_time"]) / 1000)
+
+                if now - last_renewed > self.lease_timeout:
+                    os.rename(leased_path, self.get_path(PENDING_DIR, lease_match["name"]))
+                    logging.warning("Lease '{}' expired, returned it to the queue".format(leased_name))
+
+            except FileNotFoundError:
+                pass
+
+    def get_entries(self, subdirectory: str) -> typing.List[str]:
+        """
+        Returns the names of the entries in the pending or leased subdirectory
+        """
+        pattern = LEASE_PATTERN if subdirectory == LEASED_DIR else ENTRY_PATTERN
+        return [name for name in os.listdir(os.path.join(self.directory, subdirectory)) if pattern.match(name)]
+
+    def has_work(self) -> bool:
+        """
+        Returns True if any entries are pending, or leased by a worker which may still fail to finish them
+        """
+        return any(len(self.get_entries(subdirectory)) > 0 for subdirectory in (PENDING_DIR, LEASED_DIR))
+
+    def _finish(self, lease: Lease, subdirectory: str) -> bool:
+        with self.lock:
+            self.active_leases.pop(lease.name, None)
+
+        try:
+            os.rename(lease.leased_path, self.get_path(subdirectory, lease.name))
+            return True
+
+        except FileNotFoundError:
+            logging.warning("Lease '{}' was lost before it was finished".format(lease.name))
+            return False
+
+    def complete(self, lease: Lease) -> bool:
+        return self._finish(lease, DONE_DIR)
+
+    def fail(self, lease: Lease, error: str) -> bool:
+        with open(self.get_path(FAILED_DIR, "{}.error".format(lease.name)), 'w') as f:
+            f.write(error)
+
+        return self._finish(lease, FAILED_DIR)
+
+    def renew_leases(self):
+        with self.lock:
+            leases = list(self.active_leases.values())
+
+        for lease in leases:
+            try:
+                os.utime(lease.leased_path)
+
+            except FileNotFoundError:
+                logging.warning("Lease '{}' was lost while it was being processed".format(lease.name))
+
+    def start_heartbeat(self):
+        """
+        Starts a thread which refreshes every lease held by this worker three times per lease timeout
+        """
+        def heartbeat():
+            while True:
+                time.sleep(self.lease_timeout / 3)
+                self.renew_leases()
+
+        self.heartbeat_thread = threading.Thread(target=heartbeat, name="spool-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
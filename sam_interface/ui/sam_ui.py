@@ -264,7 +264,8 @@ class ExportInterface(base_top_level.BaseTopLevel):
                 self.detail_polygon_tree_variable.get(),
                 self.detail_raster_variable.get(),
                 self.min_size_variable.get(),
-                self.threshold_variable.get()
+                self.threshold_variable.get(),
+                export_prefs.get("detail_workers", 1)
             ], daemon=True
         )
         loading_thread.start()
@@ -289,13 +290,13 @@ class ExportInterface(base_top_level.BaseTopLevel):
             save_raster: bool = True, save_centroids: bool = True,
             save_detail_mask_tree: bool = True, save_detail_vector_tree: bool = True,
             save_detail_raster: bool = True, min_area: int = 5,
-            tolerance: float = 0.05
+            tolerance: float = 0.05, detail_workers: int = 1
     ):
         try:
             export.full_export(
                 self.segment_manager, path, name, save_mask_tree, save_vector_tree,
                 save_raster, save_centroids, save_detail_mask_tree, save_detail_vector_tree, save_detail_raster,
-                min_area, tolerance
+                min_area, tolerance, detail_workers
             )
 
         except Exception:
@@ -355,7 +356,7 @@ class SAMInterface(base_interface.BaseInterface):
             return
 
         logging.info("Saving state to '{}'...".format(path))
-        self.segment_manager.save(path)
+        self.segment_manager.save(path, include_embedding=True)
 
         logging.info("Adding path to list of recent files...")
         preferences.add_recent_file(path)
@@ -1,2 +1,3 @@
 from segmentation.flood_fill_segmentation import FloodFillSegmentation
 from segmentation.base_segmentation import BaseSegmentation
+from segmentation.label_masks import LabelMasks
@@ -5,6 +5,8 @@ import typing
 import numpy as np
 import scipy.ndimage as ndimage
 
+CROPPED_MASK_TYPE = typing.Tuple[np.ndarray, typing.Tuple[int, int]]
+
 
 def color_stretch(image, mask=None, max_value: float = 1, sigmoid_const: float = 10):
     if mask is None:
@@ -25,6 +27,125 @@ def color_stretch(image, mask=None, max_value: float = 1, sigmoid_const: float =
     return amplified
 
 
+def get_bounding_box(mask: np.ndarray, margin: int = 0) -> typing.Tuple[slice, slice]:
+    """
+    Returns the row and column slices of the smallest box containing the mask, grown by the margin and clipped to
+    the mask's shape
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+
+    if len(rows) == 0:
+        return slice(0, 0), slice(0, 0)
+
+    height, width = mask.shape
+
+    return (
+        slice(max(rows[0] - margin, 0), min(rows[-1] + margin + 1, height)),
+        slice(max(columns[0] - margin, 0), min(columns[-1] + margin + 1, width))
+    )
+
+
+def get_cropped_bounding_box(
+        crop: np.ndarray, origin: tuple, shape: tuple, margin: int = 0
+) -> typing.Tuple[slice, slice]:
+    """
+    Same as get_bounding_box, for a mask cropped with the specified (row, column) offset from a mask of the specified
+    shape. The slices are in the coordinates of the full mask.
+    """
+    rows, columns = get_bounding_box(crop)
+
+    if rows.stop == 0:
+        return slice(0, 0), slice(0, 0)
+
+    return (
+        slice(max(rows.start + origin[0] - margin, 0), min(rows.stop + origin[0] + margin, shape[0])),
+        slice(max(columns.start + origin[1] - margin, 0), min(columns.stop + origin[1] + margin, shape[1]))
+    )
+
+
+def realign_mask(
+        crop: np.ndarray, origin: tuple, box_origin: tuple, box_shape: tuple, fill_value: bool = False
+) -> np.ndarray:
+    """
+    Moves a cropped mask with the specified (row, column) offset into a box with a different offset and shape. Parts
+    of the crop outside the box are cut off, and parts of the box outside the crop are set to the fill value.
+    """
+    mask = np.full(box_shape, fill_value, dtype=bool)
+
+    top, left = max(origin[0], box_origin[0]), max(origin[1], box_origin[1])
+    bottom = min(origin[0] + crop.shape[0], box_origin[0] + box_shape[0])
+    right = min(origin[1] + crop.shape[1], box_origin[1] + box_shape[1])
+
+    if bottom > top and right > left:
+        mask[top - box_origin[0]:bottom - box_origin[0], left - box_origin[1]:right - box_origin[1]] = crop[
+            top - origin[0]:bottom - origin[0], left - origin[1]:right - origin[1]
+        ]
+
+    return mask
+
+
+def paste_mask(crop: np.ndarray, origin: tuple, shape: tuple, fill_value: bool = False) -> np.ndarray:
+    """
+    Places a cropped mask with the specified (row, column) offset onto a mask of the specified shape, which is set to
+    the fill value everywhere outside the crop
+    """
+    mask = np.full(shape, fill_value, dtype=bool)
+    mask[origin[0]:origin[0] + crop.shape[0], origin[1]:origin[1] + crop.shape[1]] = crop
+
+    return mask
+
+
+def get_uncontained(
+        masks: typing.Sequence[np.ndarray], origins: typing.Sequence[tuple] = None,
+        areas: typing.Sequence[int] = None
+) -> typing.List[int]:
+    """
+    Returns the indices of the masks which are not fully contained within any of the other masks. Pairs are first
+    ruled out by comparing bounding boxes and areas, so the exact check only runs over the contained mask's bounding
+    box for pairs which could overlap.
+    :param origins: the (row, column) offset of each mask, if the masks are cropped to their bounding boxes. Full masks
+    are cropped first, which scans each of them once.
+    :param areas: the number of set pixels in each mask, if already known
+    """
+    if origins is None:
+        boxes = [get_bounding_box(mask) for mask in masks]
+        masks = [mask[box] for mask, box in zip(masks, boxes)]
+        origins = [(rows.start, columns.start) for rows, columns in boxes]
+
+    if areas is None:
+        areas = [mask.sum() for mask in masks]
+
+    if len(masks) == 0:
+        return []
+
+    areas = np.asarray(areas, dtype=np.int64)
+
+    top, left = np.array(origins, dtype=np.int64).reshape(-1, 2).T
+    heights, widths = np.array([mask.shape for mask in masks], dtype=np.int64).reshape(-1, 2).T
+    bottom, right = top + heights, left + widths
+
+    uncontained = []
+    for i, inner in enumerate(masks):
+        candidates = np.flatnonzero(
+            (top <= top[i]) & (bottom >= bottom[i]) & (left <= left[i]) & (right >= right[i]) & (areas >= areas[i])
+        )
+
+        for j in candidates:
+            if i == j:
+                continue
+
+            outer = masks[j][top[i] - top[j]:bottom[i] - top[j], left[i] - left[j]:right[i] - left[j]]
+
+            if np.logical_and(inner, outer).sum() == areas[i]:
+                break
+
+        else:
+            uncontained.append(i)
+
+    return uncontained
+
+
 class BaseSegmentation(abc.ABC):
     def __init__(self, min_area: int, silent: bool = False):
         super().__init__()
@@ -39,44 +160,101 @@ class BaseSegmentation(abc.ABC):
 
         return self._segment(image, mask)
 
+    def segment_labels(
+            self, image: np.ndarray, mask: np.ndarray = None, stretch_colors: bool = False
+    ) -> np.ndarray:
+        """
+        Segments the image into a single int32 label image, where 0 is outside the mask and labels 1 to n are the n
+        segments, in the same order as returned by segment
+        """
+        if stretch_colors:
+            image = color_stretch(image, mask)
+
+        return self._label(image, mask)
+
     def segment_with_remainder(
             self, image: np.ndarray, mask: np.ndarray = None, offset: int = 5
     ) -> typing.Tuple[typing.List[np.ndarray], np.ndarray]:
+        crops, (remainder, origin) = self.segment_cropped_with_remainder(image, mask, offset)
+        shape = image.shape[:2]
+
+        return [paste_mask(crop, o, shape) for crop, o in crops], paste_mask(remainder, origin, shape, True)
+
+    def segment_cropped_with_remainder(
+            self, image: np.ndarray, mask: np.ndarray = None, offset: int = 5, margin: int = 1,
+            mask_origin: tuple = (0, 0)
+    ) -> typing.Tuple[typing.List[CROPPED_MASK_TYPE], CROPPED_MASK_TYPE]:
+        """
+        Same as segment_with_remainder, but only segments the bounding box of the mask (plus the margin). Each segment
+        is returned cropped to its own bounding box along with the (row, column) offset of that box in the image, and
+        the remainder is cropped to the segmented box.
+        Segments are read from the label image (see segment_labels), so each segment is only processed within its box.
+        :param mask_origin: the (row, column) offset of the mask in the image, if the mask is cropped
+        """
+        height, width = image.shape[:2]
+
+        if mask is None:
+            rows, columns = slice(0, height), slice(0, width)
+
+        else:
+            rows, columns = get_cropped_bounding_box(mask, mask_origin, (height, width), margin)
+            mask = realign_mask(
+                mask, mask_origin, (rows.start, columns.start), (rows.stop - rows.start, columns.stop - columns.start)
+            )
+
+        origin = (rows.start, columns.start)
+        image = image[rows, columns]
+
+        # edge checks are made against the edges of the full image, not the edges of the crop. Each edge range starts
+        # or ends at the edge, so a segment has pixels within it exactly when its bounding box overlaps it.
+        near_edges = [
+            (slice(None, offset + 1).indices(length), slice(-offset + 1, None).indices(length))
+            for length in (height, width)
+        ]
+
+        def touches_both_edges(box: slice, axis: int) -> bool:
+            start, stop = box.start + origin[axis], box.stop + origin[axis]
+
+            return all(start < edge_stop and stop > edge_start for edge_start, edge_stop, _ in near_edges[axis])
 
-        segments = self.segment(image, mask)
         remainder = np.ones(image.shape[:2], dtype=bool)
 
-        valid_segments = []
-        for segment in segments:
-            if segment[:, :offset + 1].sum() > 0 and segment[:, -offset + 1:].sum() > 0:
-                remainder = np.logical_or(remainder, segment)
-                continue
+        if image.size == 0:
+            return [], (remainder, origin)
 
-            if segment[:offset + 1].sum() > 0 and segment[-offset + 1:].sum() > 0:
-                remainder = np.logical_or(remainder, segment)
+        labels = self.segment_labels(image, mask)
+        areas = np.bincount(labels.ravel())
+
+        crops = []
+        crop_origins = []
+
+        for label, box in enumerate(ndimage.find_objects(labels), start=1):
+            if box is None:
                 continue
 
-            if segment.sum() < self.min_area:
-                remainder = np.logical_or(remainder, segment)
+            box_rows, box_columns = box
+
+            if touches_both_edges(box_columns, 1) or touches_both_edges(box_rows, 0) or areas[label] < self.min_area:
                 continue
 
-            valid_segments.append(ndimage.binary_fill_holes(segment))
+            # holes are filled within the box, with a margin so the outside is connected around the segment
+            segment = np.pad(labels[box] == label, 1)
+            crops.append(ndimage.binary_fill_holes(segment)[1:-1, 1:-1])
+            crop_origins.append((box_rows.start + origin[0], box_columns.start + origin[1]))
 
         accepted = []
-        for i, outer in enumerate(valid_segments):
-            area = outer.sum()
+        for i in get_uncontained(crops, crop_origins):
+            accepted.append((crops[i], crop_origins[i]))
 
-            for j, inner in enumerate(valid_segments):
-                if i == j:
-                    continue
+        return accepted, (remainder, origin)
 
-                if np.logical_and(outer, inner).sum() == area:
-                    break
+    def _label(self, image: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        labels: np.ndarray = np.zeros(image.shape[:2], dtype=np.int32)
 
-            else:
-                accepted.append(outer)
+        for i, segment in enumerate(self._segment(image, mask)):
+            labels[segment] = i + 1
 
-        return accepted, remainder
+        return labels
 
     @abc.abstractmethod
     def _segment(self, image: np.ndarray, mask: np.ndarray = None):
@@ -1,9 +1,24 @@
 import logging
 
 import numpy as np
-import scipy.ndimage as ndimage
 
 import segmentation.base_segmentation as base_segmentation
+import segmentation.label_masks as label_masks
+
+
+def neighbour_indices(indices: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    Returns the flat indices of the 4-connected neighbours of the specified flat indices (with duplicates)
+    """
+    height, width = shape
+    columns = indices % width
+
+    return np.concatenate((
+        indices[columns > 0] - 1,
+        indices[columns < width - 1] + 1,
+        indices[indices >= width] - width,
+        indices[indices < (height - 1) * width] + width
+    ))
 
 
 class FloodFillSegmentation(base_segmentation.BaseSegmentation):
@@ -11,71 +26,107 @@ class FloodFillSegmentation(base_segmentation.BaseSegmentation):
         super().__init__(min_area, silent=silent)
         self.tolerance = tolerance
 
-    def flood(self, image: np.ndarray, mask: np.ndarray, seed):
-        iteration = 0
-
+    def flood(self, image: np.ndarray, mask: np.ndarray, seed) -> np.ndarray:
         accepted_mask: np.ndarray = np.zeros(mask.shape, dtype=np.bool_)
-        initial_color: np.ndarray = image[seed]
-        accepted_mask[*seed] = True
 
-        mask = mask.copy()
+        flat_image = image.reshape(-1, image.shape[-1]) if image.ndim == 3 else image.reshape(-1, 1)
+        seed_index = np.ravel_multi_index(seed, mask.shape)
 
-        while True:
-            iteration += 1
+        accepted_mask.ravel()[self.flood_indices(flat_image, mask.ravel(), mask.shape, seed_index)] = True
+        return accepted_mask
 
-            dilated = ndimage.binary_dilation(accepted_mask, iterations=2, mask=mask)
-            frontier = np.logical_and(dilated, np.logical_not(accepted_mask))
+    def flood_indices(
+            self, flat_image: np.ndarray, flat_mask: np.ndarray, shape: tuple, seed_index: int,
+            visited: np.ndarray = None, stamp=True
+    ) -> np.ndarray:
+        """
+        Grows a region from the seed, only ever inspecting pixels within two steps of the pixels accepted during
+        the previous iteration. This produces the same region as repeatedly dilating the entire accepted mask by
+        two pixels, since every pixel next to an older accepted pixel has already been accepted or rejected.
+        :param flat_image: the image, reshaped to (pixels, channels)
+        :param flat_mask: the flattened mask of pixels which may be added to the region
+        :param shape: the (height, width) of the unflattened mask
+        :param seed_index: the flat index of the pixel to grow the region from
+        :param visited: flattened scratch array which is set to the stamp for every pixel inspected by this fill.
+        Must not contain the stamp yet. If not specified, one is allocated.
+        :param stamp: the value written to the scratch array. Using a new stamp for every fill allows one scratch
+        array to be shared between fills without clearing it
+        :return: the flat indices of each pixel in the region
+        """
+        if visited is None:
+            visited = np.zeros(flat_mask.shape, dtype=np.bool_)
+
+        initial_color: np.ndarray = flat_image[seed_index]
+        visited[seed_index] = stamp
+
+        newly_accepted = np.array([seed_index], dtype=np.intp)
+        accepted = [newly_accepted]
 
-            if frontier.sum() == 0:
-                break
+        while True:
+            inner = np.unique(neighbour_indices(newly_accepted, shape))
+            inner = inner[flat_mask[inner] & (visited[inner] != stamp)]
+            visited[inner] = stamp
 
-            coordinates = np.where(frontier == 1)
-            distance = np.linalg.norm(np.subtract(image[coordinates], initial_color), axis=1)
+            outer = np.unique(neighbour_indices(inner, shape))
+            outer = outer[flat_mask[outer] & (visited[outer] != stamp)]
+            visited[outer] = stamp
 
-            accepted_coordinates = np.where(distance < self.tolerance)[0]
-            rejected_coordinates = np.where(distance >= self.tolerance)[0]
+            frontier = np.concatenate((inner, outer))
 
-            if len(accepted_coordinates) == 0:
+            if len(frontier) == 0:
                 break
 
-            np_coordinates = np.array(coordinates)
+            distance = np.linalg.norm(np.subtract(flat_image[frontier], initial_color), axis=1)
+            newly_accepted = frontier[distance < self.tolerance]
 
-            for c in np_coordinates.T[accepted_coordinates]:
-                accepted_mask[*c] = 1
+            if len(newly_accepted) == 0:
+                break
 
-            for c in np_coordinates.T[rejected_coordinates]:
-                mask[*c] = 0
+            accepted.append(newly_accepted)
 
-        return accepted_mask
-
-    def _segment(self, image: np.ndarray, mask: np.ndarray = None):
-        masks = []
+        return np.concatenate(accepted)
 
+    def _label(self, image: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
         if mask is None:
             mask = np.ones(image.shape[:2], dtype=bool)
 
-        remaining_mask = mask.copy()
+        shape = mask.shape
+        flat_image = image.reshape(-1, image.shape[-1]) if image.ndim == 3 else image.reshape(-1, 1)
 
-        total_pixels = remaining_mask.size
+        labels: np.ndarray = np.zeros(shape, dtype=np.int32)
+        flat_labels = labels.ravel()
 
-        iteration = 0
-        while True:
-            iteration += 1
+        remaining_mask = mask.flatten()
+        visited: np.ndarray = np.zeros(remaining_mask.shape, dtype=np.int32)
 
-            candidate_seeds = np.where(remaining_mask == 1)
+        candidate_seeds = np.flatnonzero(remaining_mask)
+        cursor = 0
+        window = 64
+        label = 0
 
-            if len(candidate_seeds[0]) == 0:
-                break
+        while cursor < len(candidate_seeds):
+            # advance the cursor to the next unclaimed pixel, widening the search window while it keeps missing
+            available = remaining_mask[candidate_seeds[cursor:cursor + window]]
+
+            if not available.any():
+                cursor += window
+                window *= 2
+                continue
 
-            if not self.silent and iteration % 100 == 0:
-                remaining = (len(candidate_seeds[0]) / total_pixels)
-                left = 1 - remaining
-                logging.info("Flood Fill Progress: {:.3f}%".format(left * 100))
+            cursor += int(np.argmax(available))
+            window = 64
 
-            seed = (candidate_seeds[0][0], candidate_seeds[1][0])
-            fill_mask = self.flood(image, remaining_mask, seed)
+            label += 1
 
-            remaining_mask = np.logical_and(remaining_mask, np.logical_not(fill_mask))
-            masks.append(fill_mask)
+            if not self.silent and label % 100 == 0:
+                logging.info("Flood Fill Progress: {:.3f}%".format(cursor / len(candidate_seeds) * 100))
 
-        return masks
+            region = self.flood_indices(flat_image, remaining_mask, shape, candidate_seeds[cursor], visited, label)
+
+            remaining_mask[region] = False
+            flat_labels[region] = label
+
+        return labels
+
+    def _segment(self, image: np.ndarray, mask: np.ndarray = None):
+        return label_masks.LabelMasks(self._label(image, mask))
@@ -0,0 +1,43 @@
+import typing
+
+import numpy as np
+
+
+class LabelMasks(typing.Sequence[np.ndarray]):
+    """
+    Lazy sequence of boolean masks backed by a single label image, where label 0 is unlabeled and labels 1 to n are
+    the n segments. Each mask is only materialized when it is accessed.
+    """
+    def __init__(self, labels: np.ndarray):
+        self.labels = labels
+
+        flat_labels = labels.ravel()
+        self._order = np.argsort(flat_labels, kind='stable')
+        self._offsets = np.cumsum(np.bincount(flat_labels, minlength=1))
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("Label mask index {} out of range".format(index))
+
+        mask = np.zeros(self.labels.shape, dtype=np.bool_)
+        mask.ravel()[self.get_indices(index + 1)] = True
+
+        return mask
+
+    def get_indices(self, label: int) -> np.ndarray:
+        """
+        Returns the flat indices of each pixel with the specified label
+        """
+        return self._order[self._offsets[label - 1]:self._offsets[label]]
+
+    def get_areas(self) -> np.ndarray:
+        return np.diff(self._offsets)
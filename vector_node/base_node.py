@@ -1,5 +1,6 @@
 import abc
 import copy
+import io
 import json
 import pickle
 import collections
@@ -7,6 +8,9 @@ import typing
 
 import numpy as np
 
+# version 2 stores masks as COCO compressed RLEs instead of nested lists
+JSON_VERSION = 2
+
 
 class BaseNode(abc.ABC):
     def __init__(self, color: np.ndarray = None, level: int = 0):
@@ -21,7 +25,10 @@ class BaseNode(abc.ABC):
 
     def save(self, filename: str):
         with open(filename, 'wb') as f:
-            f.write(pickle.dumps(self))
+            f.write(self.to_bytes())
+
+    def to_bytes(self) -> bytes:
+        return pickle.dumps(self)
 
     def pre_order_traversal(self, include_self: bool = True) -> typing.Iterable[typing.Self]:
         """
@@ -88,20 +95,130 @@ class BaseNode(abc.ABC):
 
         self.children.extend(children)
 
-    def to_dict(self) -> dict:
+    def to_record(self) -> dict:
+        """
+        Returns the JSON serializable data of this node, without its children
+        """
+        pass
+
+    @classmethod
+    def from_record(cls, record: dict, version: int = JSON_VERSION) -> 'typing.Self':
+        """
+        Creates a node without children from the data returned by to_record
+        """
         pass
 
+    def to_dict(self) -> dict:
+        result = self.to_record()
+        result["children"] = [child.to_dict() for child in self.children]
+
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict, version: int = JSON_VERSION) -> 'typing.Self':
+        node = cls.from_record(data, version)
+        node.add_children([cls.from_dict(child, version) for child in data["children"]])
+
+        return node
+
+    def write_json(self, f: typing.TextIO):
+        """
+        Writes the same JSON as to_json_string to the file one node at a time, so the whole structure is never held in
+        memory
+        """
+        f.write('{"objects": ')
+
+        def write_record(node: typing.Self):
+            record = json.dumps(node.to_record())
+            f.write(record[:-1] + (', ' if len(record) > 2 else '') + '"children": [')
+
+        write_record(self)
+
+        # the children left to write of each open node, and whether any have been written yet
+        stack = [[iter(self.children), False]]
+
+        while stack:
+            child = next(stack[-1][0], None)
+
+            if child is None:
+                f.write(']}')
+                stack.pop()
+                continue
+
+            if stack[-1][1]:
+                f.write(', ')
+
+            stack[-1][1] = True
+
+            write_record(child)
+            stack.append([iter(child.children), False])
+
+        f.write(', "version": {}}}'.format(JSON_VERSION))
+
     def to_json_string(self) -> str:
-        structure_data = self.to_dict()
+        f = io.StringIO()
+        self.write_json(f)
 
-        return json.dumps(dict(
-            objects=structure_data,
-            version=1
-        ))
+        return f.getvalue()
 
     def to_json_file(self, filename: str):
-        with open(filename, 'w') as f:
-            f.write(self.to_json_string())
+        with open(filename, 'w', buffering=1024 * 1024) as f:
+            self.write_json(f)
+
+    def write_ndjson(self, f: typing.TextIO):
+        """
+        Writes one JSON record per line for each node in pre-order, so readers can process the tree incrementally.
+        Each record has the id of the node (its position in the file) and the id of its parent (None for the root),
+        so every parent appears before its children.
+        """
+        parents = {}
+
+        for i, node in enumerate(self.pre_order_traversal()):
+            record = node.to_record()
+            record.update(id=i, parent=parents.pop(id(node), None), level=node.level)
+
+            f.write(json.dumps(record) + "\n")
+
+            for child in node.children:
+                parents[id(child)] = i
+
+    def to_ndjson_file(self, filename: str):
+        with open(filename, 'w', buffering=1024 * 1024) as f:
+            self.write_ndjson(f)
+
+    @classmethod
+    def from_ndjson_file(cls, filename: str) -> 'typing.Self':
+        nodes = []
+
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                node = cls.from_record(record)
+
+                if record["parent"] is not None:
+                    nodes[record["parent"]].add_child(node)
+
+                nodes.append(node)
+
+        return nodes[0]
+
+    @classmethod
+    def from_json_string(cls, string: str) -> 'typing.Self':
+        data = json.loads(string)
+
+        if data["version"] > JSON_VERSION:
+            raise ValueError("Unsupported JSON version {}".format(data["version"]))
+
+        return cls.from_dict(data["objects"], data["version"])
+
+    @classmethod
+    def from_json_file(cls, filename: str) -> 'typing.Self':
+        with open(filename) as f:
+            return cls.from_json_string(f.read())
 
     def color_to_int(self, scale: float = 255) -> np.ndarray:
         return (self.color * scale).astype(int)
+
+    @staticmethod
+    def color_from_int(color: list, scale: float = 255) -> np.ndarray:
+        return np.array(color) / scale
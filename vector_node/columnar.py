@@ -0,0 +1,218 @@
+import json
+import os
+import socket
+import struct
+import typing
+
+import numpy as np
+
+# files start with the magic, followed by the length of a JSON header describing where each array is stored
+MAGIC = b"VNODECOL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# stored for nodes without a category
+NO_CATEGORY = np.iinfo(np.int64).min
+
+
+def is_columnar(filename: str) -> bool:
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write(filename: str, root) -> int:
+    """
+    Saves the tree of vector nodes as a single file of flat arrays, with the nodes numbered in pre-order:
+        coordinates: every exterior, one after another
+        ring_offsets: the start of each node's exterior in coordinates, followed by the total number of points
+        parents: the index of each node's parent (-1 for the root)
+        child_offsets / child_indices: the indices of each node's children, in order
+        colors, categories, levels, synthetic: the attributes of each node. Trees with any category which is not an
+            integer store the categories in the header instead, which requires them to be JSON serializable.
+    :return: the number of nodes saved
+    """
+    nodes = list(root.pre_order_traversal())
+    indices = {id(node): i for i, node in enumerate(nodes)}
+
+    exteriors = [np.asarray(node.exterior, dtype=np.float64).reshape(-1, 2) for node in nodes]
+    ring_offsets = np.concatenate(([0], np.cumsum([len(e) for e in exteriors]))).astype(np.int64)
+
+    parents = np.full(len(nodes), -1, dtype=np.int64)
+    child_counts = np.zeros(len(nodes), dtype=np.int64)
+
+    for i, node in enumerate(nodes):
+        child_counts[i] = len(node.children)
+
+        for child in node.children:
+            parents[indices[id(child)]] = i
+
+    # in pre-order, the children of each node are listed in order once grouped by parent
+    child_indices = np.argsort(parents[1:], kind='stable').astype(np.int64) + 1
+    child_offsets = np.concatenate(([0], np.cumsum(child_counts))).astype(np.int64)
+
+    colors = [node.color for node in nodes]
+    channels = next((len(c) for c in colors if c is not None), 0)
+
+    categories = [int(node.category) if isinstance(node.category, np.integer) else node.category for node in nodes]
+    integer_categories = all(c is None or isinstance(c, (int, np.integer)) for c in categories)
+
+    arrays = dict(
+        coordinates=np.concatenate(exteriors),
+        ring_offsets=ring_offsets,
+        parents=parents,
+        child_offsets=child_offsets,
+        child_indices=child_indices,
+        colors=np.array([
+            np.full(channels, np.nan) if c is None else np.asarray(c, dtype=np.float64) for c in colors
+        ], dtype=np.float64).reshape(len(nodes), channels),
+        categories=np.array([
+            NO_CATEGORY if not integer_categories or c is None else c for c in categories
+        ], dtype=np.int64),
+        levels=np.array([node.level for node in nodes], dtype=np.int64),
+        synthetic=np.array([node.synthetic for node in nodes], dtype=bool)
+    )
+
+    header = dict(version=FORMAT_VERSION, node_count=len(nodes), arrays={})
+
+    if not integer_categories:
+        # other categories are stored in the header, as long as they can be written to JSON
+        for node, category in zip(nodes, categories):
+            try:
+                json.dumps(category)
+
+            except TypeError:
+                raise TypeError("Cannot save category {!r} of node {} to a columnar file".format(
+                    category, indices[id(node)]
+                ))
+
+        header["categories"] = categories
+
+    # array offsets depend on the header length, so they are counted from the end of the header, then aligned
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        header["arrays"][name] = dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset)
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    # trees opened from the file being replaced are memory mapped from it, so the file is written to a new path and
+    # moved into place, which leaves the existing maps reading the old file
+    temp_filename = "{}.{}-{}.tmp".format(filename, socket.gethostname(), os.getpid())
+
+    try:
+        with open(temp_filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+
+            for name, array in arrays.items():
+                f.seek(data_start + header["arrays"][name]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+
+        os.replace(temp_filename, filename)
+
+    finally:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+
+    return len(nodes)
+
+
+class ColumnarTree:
+    """
+    Read only access to a tree saved with write. The arrays are memory mapped, so opening the file does not read
+    them, and only the parts which are accessed are read from disk. The maps are copy on write, so the arrays can be
+    modified in memory, which does not change the file.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("'{}' is not a columnar polygon tree".format(filename))
+
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError("Unsupported columnar polygon tree version {}".format(header["version"]))
+
+        data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        self.node_count = header["node_count"]
+        self.categories = header.get("categories")
+        self.arrays: typing.Dict[str, np.ndarray] = {}
+
+        for name, info in header["arrays"].items():
+            shape = tuple(info["shape"])
+
+            if np.prod(shape) == 0:
+                # empty arrays cannot be memory mapped
+                self.arrays[name] = np.zeros(shape, dtype=info["dtype"])
+
+            else:
+                # plain views of the memory map are much faster to index than np.memmap itself
+                self.arrays[name] = np.asarray(np.memmap(
+                    filename, dtype=info["dtype"], mode='c', offset=data_start + info["offset"], shape=shape
+                ))
+
+    def __len__(self) -> int:
+        return self.node_count
+
+    def get_nodes(self, indices: np.ndarray) -> typing.List[tuple]:
+        """
+        Returns the (exterior, category, color, level, synthetic) of each node, reading the attributes of every node
+        at once
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        coordinates = self.arrays["coordinates"]
+        ring_offsets = self.arrays["ring_offsets"]
+
+        starts, stops = ring_offsets[indices].tolist(), ring_offsets[indices + 1].tolist()
+        exteriors = [coordinates[start:stop] for start, stop in zip(starts, stops)]
+
+        if self.categories is not None:
+            categories = [self.categories[i] for i in indices.tolist()]
+
+        else:
+            categories = [None if c == NO_CATEGORY else c for c in self.arrays["categories"][indices].tolist()]
+
+        colors = np.array(self.arrays["colors"][indices])
+        missing = np.isnan(colors).all(axis=1) if colors.shape[1] > 0 else np.ones(len(indices), dtype=bool)
+        colors = [None if m else c for c, m in zip(colors, missing.tolist())]
+
+        return list(zip(
+            exteriors, categories, colors, self.arrays["levels"][indices].tolist(),
+            self.arrays["synthetic"][indices].tolist()
+        ))
+
+    def get_exterior(self, index: int) -> np.ndarray:
+        ring_offsets = self.arrays["ring_offsets"]
+        return self.arrays["coordinates"][ring_offsets[index]:ring_offsets[index + 1]]
+
+    def get_child_indices(self, index: int) -> np.ndarray:
+        child_offsets = self.arrays["child_offsets"]
+        return self.arrays["child_indices"][child_offsets[index]:child_offsets[index + 1]]
+
+    def get_parent_index(self, index: int) -> typing.Optional[int]:
+        parent = int(self.arrays["parents"][index])
+        return None if parent < 0 else parent
+
+    def get_color(self, index: int) -> typing.Optional[np.ndarray]:
+        color = np.array(self.arrays["colors"][index])
+        return None if len(color) == 0 or np.isnan(color).all() else color
+
+    def get_category(self, index: int) -> typing.Any:
+        if self.categories is not None:
+            return self.categories[index]
+
+        category = int(self.arrays["categories"][index])
+        return None if category == NO_CATEGORY else category
+
+    def get_level(self, index: int) -> int:
+        return int(self.arrays["levels"][index])
+
+    def is_synthetic(self, index: int) -> bool:
+        return bool(self.arrays["synthetic"][index])
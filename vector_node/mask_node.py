@@ -1,18 +1,116 @@
+import typing
+
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import shapely
 import scipy.ndimage as ndimage
 
+import segmentation.base_segmentation as base_segmentation
 import vector_node.base_node as base_node
+import vector_node.rle as rle
 import vector_node.vector_node as vector_node
 
 
 class MaskNode(base_node.BaseNode):
-    def __init__(self, mask: np.ndarray, color: np.ndarray = None, level: int = 0):
+    """
+    Node holding a boolean mask, which is stored cropped to a box containing every set pixel along with the offset of
+    that box, so nodes of small segments of large images stay small. The operations between masks work on the crops,
+    and the full mask is only created when the mask or filled_mask is read.
+    """
+    def __init__(
+            self, mask: np.ndarray, color: np.ndarray = None, level: int = 0, origin: tuple = (0, 0),
+            shape: tuple = None
+    ):
+        """
+        :param mask: the mask, which may be cropped to any box containing every set pixel
+        :param origin: the (row, column) of the top left corner of the cropped mask in the full mask
+        :param shape: the shape of the full mask. Defaults to the shape of the mask, when it is not cropped.
+        """
         super().__init__(color, level)
-        self.mask = mask
-        self.filled_mask = self.fill_holes()
+        self.cropped_mask = mask
+        self.origin = tuple(origin)
+        self.shape = mask.shape if shape is None else tuple(shape)
+
+        # the cropped filled mask and its offset, only filled when first needed, since filling holes is expensive
+        self._filled = None
+
+    def __setstate__(self, state: dict):
+        # trees pickled by older versions store full masks, with the filled mask computed up front
+        if "mask" in state:
+            mask = state.pop("mask")
+            state.update(
+                cropped_mask=mask, origin=(0, 0), shape=mask.shape, _filled=(state.pop("filled_mask"), (0, 0))
+            )
+
+        self.__dict__.update(state)
+
+    @property
+    def mask(self) -> np.ndarray:
+        return self._materialize(self.cropped_mask, self.origin)
+
+    @mask.setter
+    def mask(self, mask: typing.Union[np.ndarray, 'MaskNode']):
+        # the cropped results of the operations between masks (e.g. union_node) can be assigned as they are
+        if isinstance(mask, MaskNode):
+            self.cropped_mask = mask.cropped_mask
+            self.origin = mask.origin
+            self.shape = mask.shape
+
+        elif isinstance(mask, np.ndarray):
+            self.cropped_mask = mask
+            self.origin = (0, 0)
+            self.shape = mask.shape
+
+        else:
+            raise TypeError("Expected a mask array or a MaskNode, not '{}'".format(type(mask).__name__))
+
+        self._filled = None
+
+    @property
+    def filled_mask(self) -> np.ndarray:
+        return self._materialize(*self.get_cropped_filled_mask())
+
+    @filled_mask.setter
+    def filled_mask(self, filled_mask: np.ndarray):
+        self._filled = (filled_mask, (0, 0))
+
+    def _materialize(self, crop: np.ndarray, origin: tuple) -> np.ndarray:
+        if origin == (0, 0) and crop.shape == self.shape:
+            return crop
+
+        return base_segmentation.paste_mask(crop, origin, self.shape)
+
+    def get_cropped_filled_mask(self) -> base_segmentation.CROPPED_MASK_TYPE:
+        if self._filled is None:
+            self._filled = (self._fill_cropped(), self.origin)
+
+        return self._filled
+
+    def get_bounding_box(self) -> typing.Tuple[slice, slice]:
+        """
+        Returns the row and column slices of the box the mask is cropped to
+        """
+        return (
+            slice(self.origin[0], self.origin[0] + self.cropped_mask.shape[0]),
+            slice(self.origin[1], self.origin[1] + self.cropped_mask.shape[1])
+        )
+
+    @staticmethod
+    def _as_cropped(mask: typing.Union[np.ndarray, 'MaskNode']) -> base_segmentation.CROPPED_MASK_TYPE:
+        if isinstance(mask, MaskNode):
+            return mask.cropped_mask, mask.origin
+
+        rows, columns = base_segmentation.get_bounding_box(mask)
+        return mask[rows, columns], (rows.start, columns.start)
+
+    def _from_box(self, rows: slice, columns: slice, crop: np.ndarray) -> 'MaskNode':
+        return MaskNode(crop, origin=(rows.start, columns.start), shape=self.shape)
+
+    def _realign(self, crop: np.ndarray, origin: tuple, rows: slice, columns: slice) -> np.ndarray:
+        return base_segmentation.realign_mask(
+            crop, origin, (rows.start, columns.start), (rows.stop - rows.start, columns.stop - columns.start)
+        )
 
     @classmethod
     def from_image(cls, image: np.ndarray):
@@ -27,10 +125,16 @@ class MaskNode(base_node.BaseNode):
         return node
 
     def to_polygon(self, pad: int = 5) -> np.ndarray:
-        mask = self.mask
+        height, width = self.shape
+        rows, columns = self.get_bounding_box()
+
+        # sides of the crop inside the full mask are padded by at least 1 pixel, since the pixels past them are unset
+        top, left = (pad if edge == 0 else max(pad, 1) for edge in (rows.start, columns.start))
+        bottom, right = (pad if edge == length else max(pad, 1) for edge, length in (
+            (rows.stop, height), (columns.stop, width)
+        ))
 
-        if pad > 0:
-            mask = np.pad(self.mask, ((pad, pad), (pad, pad)), mode='constant')
+        mask = np.pad(self.cropped_mask, ((top, bottom), (left, right)), mode='constant')
 
         contours, _ = cv2.findContours(mask.astype(np.int32), cv2.RETR_FLOODFILL, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -40,7 +144,7 @@ class MaskNode(base_node.BaseNode):
             coords = []
 
             for point in contour:
-                coords.append([point[0][1] - pad, point[0][0] - pad])
+                coords.append([point[0][1] - top + rows.start, point[0][0] - left + columns.start])
 
             if len(coords) < 3:
                 continue
@@ -52,46 +156,152 @@ class MaskNode(base_node.BaseNode):
         return np.array(polygon.exterior.coords)
 
     def get_area(self) -> int:
-        return self.mask.sum()
+        return self.cropped_mask.sum()
 
     def draw(self):
         plt.imshow(self.mask)
 
+    def _fill_cropped(self) -> np.ndarray:
+        # no holes can be open to the outside of the crop, since nothing outside of it is set
+        return ndimage.binary_fill_holes(self.cropped_mask.astype(bool))
+
     def fill_holes(self):
-        return ndimage.binary_fill_holes(self.mask.astype(bool))
+        return self._materialize(self._fill_cropped(), self.origin)
+
+    def union_node(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> 'MaskNode':
+        """
+        :param mask: a full mask, or another node
+        :return: a new node holding the result, cropped to the box which can contain it
+        """
+        crop, origin = self._as_cropped(mask)
+        my_rows, my_columns = self.get_bounding_box()
+
+        rows = slice(min(my_rows.start, origin[0]), max(my_rows.stop, origin[0] + crop.shape[0]))
+        columns = slice(min(my_columns.start, origin[1]), max(my_columns.stop, origin[1] + crop.shape[1]))
+
+        return self._from_box(rows, columns, np.logical_or(
+            self._realign(self.cropped_mask, self.origin, rows, columns), self._realign(crop, origin, rows, columns)
+        ))
+
+    def intersection_node(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> 'MaskNode':
+        """
+        :param mask: a full mask, or another node
+        :return: a new node holding the result, cropped to the box which can contain it
+        """
+        crop, origin = self._as_cropped(mask)
+        my_rows, my_columns = self.get_bounding_box()
+
+        rows = slice(max(my_rows.start, origin[0]), min(my_rows.stop, origin[0] + crop.shape[0]))
+        columns = slice(max(my_columns.start, origin[1]), min(my_columns.stop, origin[1] + crop.shape[1]))
+
+        if rows.stop <= rows.start or columns.stop <= columns.start:
+            rows, columns = slice(self.origin[0], self.origin[0]), slice(self.origin[1], self.origin[1])
+
+        return self._from_box(rows, columns, np.logical_and(
+            self._realign(self.cropped_mask, self.origin, rows, columns), self._realign(crop, origin, rows, columns)
+        ))
+
+    def difference_node(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> 'MaskNode':
+        """
+        :param mask: a full mask, or another node
+        :return: a new node holding the result, cropped to the box which can contain it
+        """
+        crop, origin = self._as_cropped(mask)
+        rows, columns = self.get_bounding_box()
+
+        return self._from_box(rows, columns, np.logical_and(
+            self.cropped_mask, np.logical_not(self._realign(crop, origin, rows, columns))
+        ))
+
+    def dilate_node(self, iterations: int = 1, mask: typing.Union[np.ndarray, 'MaskNode'] = None) -> 'MaskNode':
+        """
+        :param mask: if specified, only pixels within this full mask or node are dilated into
+        :return: a new node holding the result, cropped to the box which can contain it
+        """
+        if iterations < 1:
+            # dilates until nothing changes, which can reach anywhere
+            rows, columns = slice(0, self.shape[0]), slice(0, self.shape[1])
 
-    def union(self, mask: np.ndarray):
-        return np.logical_or(self.mask, mask)
+        else:
+            my_rows, my_columns = self.get_bounding_box()
+            rows = slice(max(my_rows.start - iterations, 0), min(my_rows.stop + iterations, self.shape[0]))
+            columns = slice(max(my_columns.start - iterations, 0), min(my_columns.stop + iterations, self.shape[1]))
+
+        if mask is not None:
+            mask = self._realign(*self._as_cropped(mask), rows, columns)
+
+        return self._from_box(rows, columns, ndimage.binary_dilation(
+            self._realign(self.cropped_mask, self.origin, rows, columns), iterations=iterations, mask=mask
+        ))
 
-    def intersection(self, mask: np.ndarray):
-        return np.logical_and(self.mask, mask)
+    def union(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> np.ndarray:
+        """
+        :param mask: a full mask, or another node
+        :return: the full mask of the result (see union_node for the cropped result)
+        """
+        return self.union_node(mask).mask
 
-    def difference(self, mask: np.ndarray):
-        return np.logical_and(self.mask, np.logical_not(mask))
+    def intersection(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> np.ndarray:
+        """
+        :param mask: a full mask, or another node
+        :return: the full mask of the result (see intersection_node for the cropped result)
+        """
+        return self.intersection_node(mask).mask
 
-    def dilate(self, iterations: int = 1, mask: np.ndarray = None):
-        return ndimage.binary_dilation(self.mask, iterations, mask=mask)
+    def difference(self, mask: typing.Union[np.ndarray, 'MaskNode']) -> np.ndarray:
+        """
+        :param mask: a full mask, or another node
+        :return: the full mask of the result (see difference_node for the cropped result)
+        """
+        return self.difference_node(mask).mask
 
-    def is_fully_contained(self, mask: np.ndarray, cached_mask: bool = False):
+    def dilate(self, iterations: int = 1, mask: typing.Union[np.ndarray, 'MaskNode'] = None) -> np.ndarray:
+        """
+        :param mask: if specified, only pixels within this full mask or node are dilated into
+        :return: the full mask of the result (see dilate_node for the cropped result)
+        """
+        return self.dilate_node(iterations, mask).mask
+
+    def is_fully_contained(self, mask: typing.Union[np.ndarray, 'MaskNode'], cached_mask: bool = False):
+        """
+        :param mask: a full mask, or another node
+        """
         if cached_mask:
-            my_mask = self.filled_mask
+            my_crop, my_origin = self.get_cropped_filled_mask()
         else:
-            my_mask = self.fill_holes()
+            my_crop, my_origin = self._fill_cropped(), self.origin
+
+        crop, origin = self._as_cropped(mask)
+        rows = slice(origin[0], origin[0] + crop.shape[0])
+        columns = slice(origin[1], origin[1] + crop.shape[1])
 
-        return np.logical_and(my_mask, mask).sum() == mask.sum()
+        return np.logical_and(self._realign(my_crop, my_origin, rows, columns), crop).sum() == crop.sum()
 
-    def is_touching(self, mask: np.ndarray):
-        return np.logical_and(self.dilate(1), mask).sum() > 0
+    def is_touching(self, mask: typing.Union[np.ndarray, 'MaskNode']):
+        """
+        :param mask: a full mask, or another node
+        """
+        return self.dilate_node(1).intersection_node(mask).get_area() > 0
 
-    def to_dict(self) -> dict:
-        result = {
-            "mask": self.mask.tolist(),
-            "filled_mask": self.filled_mask.tolist(),
-            "children": [],
+    def to_record(self) -> dict:
+        return {
+            "mask": rle.encode(self.cropped_mask, self.origin, self.shape),
+            "filled_mask": rle.encode(*self.get_cropped_filled_mask(), self.shape),
             "color": self.color_to_int().tolist()
         }
 
-        for child in self.children:
-            result["children"].append(child.to_dict())
+    @classmethod
+    def from_record(cls, record: dict, version: int = base_node.JSON_VERSION) -> 'MaskNode':
+        if version < 2:
+            # masks were stored as nested lists
+            node = cls(np.array(record["mask"], dtype=bool), color=cls.color_from_int(record["color"]))
+            node.filled_mask = np.array(record["filled_mask"], dtype=bool)
+
+        else:
+            crop, origin, shape = rle.decode(record["mask"])
+            node = cls(crop, color=cls.color_from_int(record["color"]), origin=origin, shape=shape)
 
-        return result
+            filled_crop, filled_origin, _ = rle.decode(record["filled_mask"])
+            node._filled = (filled_crop, filled_origin)
+
+        return node
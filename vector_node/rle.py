@@ -0,0 +1,144 @@
+import typing
+
+import numpy as np
+
+RLE_TYPE = typing.Dict[str, typing.Union[typing.List[int], str]]
+
+
+def get_counts(crop: np.ndarray, origin: tuple = (0, 0), shape: tuple = None) -> np.ndarray:
+    """
+    Returns the uncompressed COCO run lengths of a mask cropped with the specified (row, column) offset from a mask of
+    the specified shape. Pixels are ordered column by column, and the runs alternate between unset and set pixels,
+    starting with unset pixels. Only the crop is read.
+    """
+    if shape is None:
+        shape = crop.shape
+
+    height, width = shape
+
+    # indices of the set pixels in the column major order of the full mask
+    columns, rows = np.nonzero(crop.T)
+    indices = (columns.astype(np.int64) + origin[1]) * height + rows + origin[0]
+
+    if len(indices) == 0:
+        return np.array([height * width], dtype=np.int64)
+
+    run_starts = np.concatenate(([0], np.flatnonzero(np.diff(indices) != 1) + 1))
+    run_stops = np.concatenate((run_starts[1:], [len(indices)]))
+
+    starts = indices[run_starts]
+    stops = indices[run_stops - 1] + 1
+
+    # every set run is preceded by an unset run, which is empty for a set first pixel
+    bounds = np.empty(len(starts) * 2 + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = stops
+    bounds[-1] = height * width
+
+    counts = np.diff(bounds)
+
+    # like the COCO API, there is no final unset run when the last pixel is set
+    return counts if counts[-1] > 0 else counts[:-1]
+
+
+def counts_to_string(counts: np.ndarray) -> str:
+    """
+    Compresses the run lengths to the string format of the COCO API (pycocotools). Each count after the third is
+    stored as the difference from the count two before, in 5 bit groups of a variable length integer.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+
+    deltas = counts.copy()
+    deltas[3:] -= counts[1:-2]
+
+    characters = []
+    for x in deltas.tolist():
+        more = True
+
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+
+            if more:
+                c |= 0x20
+
+            characters.append(chr(c + 48))
+
+    return "".join(characters)
+
+
+def string_to_counts(string: str) -> np.ndarray:
+    """
+    Decompresses run lengths in the string format of the COCO API
+    """
+    values = np.frombuffer(string.encode("ascii"), dtype=np.uint8).astype(np.int64) - 48
+
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # each count ends at the first character without the continuation bit
+    ends = np.flatnonzero((values & 0x20) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    positions = np.arange(len(values)) - np.repeat(starts, ends - starts + 1)
+    deltas = np.add.reduceat((values & 0x1f) << (5 * positions), starts)
+
+    # the last group of a negative count has its sign bit set
+    negative = (values[ends] & 0x10) != 0
+    deltas[negative] -= np.int64(1) << (5 * (positions[ends[negative]] + 1))
+
+    counts = deltas.copy()
+    counts[1::2] = np.cumsum(deltas[1::2])
+    counts[2::2] = np.cumsum(deltas[2::2])
+
+    return counts
+
+
+def encode(crop: np.ndarray, origin: tuple = (0, 0), shape: tuple = None) -> RLE_TYPE:
+    """
+    Encodes the mask as a COCO compressed RLE, which can be decoded by pycocotools.mask.decode
+    """
+    if shape is None:
+        shape = crop.shape
+
+    return {
+        "size": [int(shape[0]), int(shape[1])],
+        "counts": counts_to_string(get_counts(crop, origin, shape))
+    }
+
+
+def decode(rle: RLE_TYPE) -> typing.Tuple[np.ndarray, typing.Tuple[int, int], typing.Tuple[int, int]]:
+    """
+    Decodes a COCO RLE, either compressed or with a list of counts, to the mask cropped to the columns containing set
+    pixels, without creating the full mask
+    :return: the cropped mask, its (row, column) offset and the shape of the full mask
+    """
+    height, width = rle["size"]
+    counts = rle["counts"]
+    counts = string_to_counts(counts) if isinstance(counts, str) else np.asarray(counts, dtype=np.int64)
+
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    starts, stops = bounds[1:-1:2], bounds[2::2]
+
+    # only set runs are kept, so the crop does not contain empty runs
+    starts, stops = starts[stops > starts], stops[stops > starts]
+
+    if len(starts) == 0:
+        return np.zeros((0, 0), dtype=bool), (0, 0), (height, width)
+
+    first_column = starts[0] // height
+    last_column = (stops[-1] - 1) // height
+    offset = first_column * height
+
+    flat = np.zeros((last_column - first_column + 1) * height, dtype=np.int8)
+    np.add.at(flat, starts - offset, 1)
+    np.add.at(flat, stops[stops - offset < len(flat)] - offset, -1)
+
+    crop = np.cumsum(flat, dtype=np.int8).astype(bool).reshape(-1, height).T
+
+    set_rows = np.flatnonzero(crop.any(axis=1))
+    crop = crop[set_rows[0]:set_rows[-1] + 1]
+
+    return crop, (int(set_rows[0]), int(first_column)), (height, width)
@@ -1,22 +1,96 @@
+import functools
 import math
 import typing
+import weakref
 
 import PIL.Image
 import PIL.ImageDraw
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.spatial
 import shapely
-import shapely.affinity
 import svgwrite
 import svgwrite.shapes
 import tqdm
 
 import vector_node.base_node as base_node
+import vector_node.columnar as columnar
 
 POLYGON_TYPE = typing.Union[np.ndarray, 'vector_node', shapely.Polygon]
 
 
+# the fields of the arrays returned by VectorNode.get_metrics
+METRICS_DTYPE = np.dtype([
+    ("area", np.float64),
+    ("perimeter", np.float64),
+    ("polsby_popper_compactness", np.float64),
+    ("schwartzberg_compactness", np.float64),
+    ("length_width_ratio", np.float64),
+    ("reock_score", np.float64),
+    ("convex_hull_score", np.float64),
+    ("elongation", np.float64),
+    ("bounding_width", np.float64),
+    ("bounding_height", np.float64),
+    ("bounding_circle_radius", np.float64),
+    ("centroid", np.float64, (2, ))
+])
+
+
+def _cached_metric(function: typing.Callable) -> typing.Callable:
+    """
+    Stores the result of the method until the exterior of the node is replaced
+    """
+    @functools.wraps(function)
+    def wrapper(self):
+        if function.__name__ not in self._metrics:
+            self._metrics[function.__name__] = function(self)
+
+        return self._metrics[function.__name__]
+
+    return wrapper
+
+
+def _changes_children(method: typing.Callable) -> typing.Callable:
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ChildList(list):
+    """
+    List of the children of a vector node, which counts the changes made to it, so the spatial index of the children
+    only needs to compare the count to know if it is out of date. Replacing the exterior of an indexed child also
+    counts as a change.
+    """
+    def __init__(self, children: typing.Iterable = ()):
+        super().__init__(children)
+        self.version = 0
+
+    def __reduce_ex__(self, protocol):
+        # copies and pickles start counting again, since no index refers to them yet
+        return ChildList, (list(self),)
+
+    append = _changes_children(list.append)
+    extend = _changes_children(list.extend)
+    insert = _changes_children(list.insert)
+    remove = _changes_children(list.remove)
+    pop = _changes_children(list.pop)
+    clear = _changes_children(list.clear)
+    sort = _changes_children(list.sort)
+    reverse = _changes_children(list.reverse)
+    __setitem__ = _changes_children(list.__setitem__)
+    __delitem__ = _changes_children(list.__delitem__)
+    __iadd__ = _changes_children(list.__iadd__)
+    __imul__ = _changes_children(list.__imul__)
+
+
 class VectorNode(base_node.BaseNode):
+    # the number of children from which refit_to_parent uses the spatial index to skip children outside of the node
+    INDEXED_REFIT_MINIMUM = 32
+
     def __init__(
             self, exterior: np.ndarray, category: int = None, color: np.ndarray = None, level: int = 0
     ):
@@ -28,11 +102,243 @@ class VectorNode(base_node.BaseNode):
         self.category = category
         self.synthetic: bool = False
 
+        # spatial index of the children, built when first queried (see get_child_index)
+        self._child_index = None
+
+    @property
+    def children(self) -> ChildList:
+        return self._children
+
+    @children.setter
+    def children(self, children: typing.List['VectorNode']):
+        self._children = children if isinstance(children, ChildList) else ChildList(children)
+
+    @property
+    def exterior(self) -> np.ndarray:
+        return self._exterior
+
+    @exterior.setter
+    def exterior(self, exterior: np.ndarray):
+        # the geometry and metrics are cached until the exterior is replaced. Modifying the array in place is not
+        # detected, so the exterior should always be replaced instead.
+        self._exterior = exterior
+        self._geometry = None
+        self._metrics = {}
+
+        # the children of the parent which last indexed this node need to be indexed again
+        indexed_in = getattr(self, "_indexed_in", None)
+        siblings = None if indexed_in is None else indexed_in()
+
+        if siblings is not None:
+            siblings.version += 1
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(_geometry=None, _metrics={}, _child_index=None, _indexed_in=None)
+
+        return state
+
+    def __setstate__(self, state: dict):
+        # nodes pickled by older versions store the exterior and children directly
+        if "exterior" in state:
+            state["_exterior"] = state.pop("exterior")
+            state.update(_geometry=None, _metrics={})
+
+        if "children" in state:
+            state["_children"] = ChildList(state.pop("children"))
+
+        state.setdefault("_child_index", None)
+        state.setdefault("_indexed_in", None)
+        self.__dict__.update(state)
+
+    @classmethod
+    def load(cls, filename: str) -> 'VectorNode':
+        """
+        Loads a tree saved with save, or pickled by older versions. Columnar trees are opened lazily.
+        """
+        if columnar.is_columnar(filename):
+            return LazyVectorNode.from_tree(columnar.ColumnarTree(filename), [0])[0]
+
+        return super().load(filename)
+
+    def save(self, filename: str):
+        """
+        Saves the tree in the columnar format, which can be loaded without reading the whole file
+        """
+        columnar.write(filename, self)
+
     @classmethod
     def from_rectangle(cls, size: tuple, category: int = None, color: np.ndarray = None) -> 'VectorNode':
         size = size[::-1]
         return cls([(0, 0), (size[0], 0), (size[0], size[1]), (0, size[1])], category, color)
 
+    @staticmethod
+    def get_geometries(nodes: typing.Sequence['VectorNode']) -> np.ndarray:
+        """
+        Returns an array of the shapely polygon of each node. Polygons which are not cached yet are created together,
+        and cached on their nodes.
+        """
+        geometries = np.array([node._geometry for node in nodes], dtype=object)
+        missing = np.flatnonzero(np.equal(geometries, None))
+
+        if len(missing) > 0:
+            exteriors = [np.asarray(nodes[i].exterior, dtype=np.float64).reshape(-1, 2) for i in missing]
+            ring_indices = np.repeat(np.arange(len(missing)), [len(e) for e in exteriors])
+
+            geometries[missing] = shapely.polygons(shapely.linearrings(np.concatenate(exteriors), indices=ring_indices))
+
+            for i in missing:
+                nodes[i]._geometry = geometries[i]
+
+        return geometries
+
+    @classmethod
+    def get_metrics(cls, nodes: typing.Sequence['VectorNode']) -> np.ndarray:
+        """
+        Computes the shape metrics of every node at once with shapely's vectorized functions
+        :return: a structured array with the fields of METRICS_DTYPE, with one record per node. Each field is computed
+        the same way as the node method with the same name, up to floating point rounding.
+        """
+        geometries = cls.get_geometries(nodes)
+        metrics = np.empty(len(nodes), dtype=METRICS_DTYPE)
+
+        if len(nodes) == 0:
+            return metrics
+
+        area = shapely.area(geometries)
+        perimeter = shapely.length(geometries)
+        min_x, min_y, max_x, max_y = shapely.bounds(geometries).T
+        radius = shapely.minimum_bounding_radius(geometries)
+        centroids = shapely.centroid(geometries)
+
+        # degenerate polygons give nan or inf instead of raising like the node methods
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics["area"] = area
+            metrics["perimeter"] = perimeter
+            metrics["polsby_popper_compactness"] = 4 * math.pi * (area / perimeter ** 2)
+            metrics["schwartzberg_compactness"] = 1 / (perimeter / (2 * math.pi * np.sqrt(area / math.pi)))
+            metrics["bounding_width"] = max_x - min_x
+            metrics["bounding_height"] = max_y - min_y
+            metrics["length_width_ratio"] = metrics["bounding_width"] / metrics["bounding_height"]
+            metrics["reock_score"] = area / (math.pi * radius ** 2)
+            metrics["convex_hull_score"] = area / shapely.area(shapely.convex_hull(geometries))
+            metrics["elongation"] = np.minimum(area, perimeter) / np.maximum(area, perimeter)
+            metrics["bounding_circle_radius"] = radius
+            metrics["centroid"] = np.column_stack((shapely.get_x(centroids), shapely.get_y(centroids)))
+
+        return metrics
+
+    def get_child_metrics(self, descendants: bool = False) -> np.ndarray:
+        """
+        Returns the shape metrics of the children as a structured array (see get_metrics)
+        :param descendants: if True, every descendant is included, in level order
+        """
+        nodes = list(self.level_order_traversal(include_self=False)) if descendants else self.children
+        return self.get_metrics(nodes)
+
+    def get_child_index(self) -> shapely.STRtree:
+        """
+        Returns an STRtree of the polygons of the children, in the order of the children. The index is rebuilt when
+        the children, or the exterior of any child, have changed since it was last built, which is tracked by the
+        ChildList of the children.
+        """
+        children = self.children
+
+        if self._child_index is None or self._child_index[0] is not children or \
+                self._child_index[1] != children.version:
+            geometries = self.get_geometries(children)
+            centroids = shapely.centroid(geometries)
+
+            siblings = weakref.ref(children)
+            for child in children:
+                child._indexed_in = siblings
+
+            self._child_index = (
+                children,
+                children.version,
+                shapely.STRtree(geometries),
+                scipy.spatial.cKDTree(np.column_stack((shapely.get_x(centroids), shapely.get_y(centroids))))
+            )
+
+        return self._child_index[2]
+
+    @staticmethod
+    def _get_intersection_areas(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        try:
+            return shapely.area(shapely.intersection(a, b))
+
+        except shapely.GEOSException:
+            return shapely.area(shapely.intersection(shapely.buffer(a, 0), shapely.buffer(b, 0)))
+
+    def _group_children(self, query_indices: np.ndarray, child_indices: np.ndarray, count: int) -> list:
+        # pairs of (query, child) indices to a list of the children matching each query, in the order of the children
+        result = [[] for _ in range(count)]
+        order = np.lexsort((child_indices, query_indices))
+
+        for query, child in zip(query_indices[order].tolist(), child_indices[order].tolist()):
+            result[query].append(self.children[child])
+
+        return result
+
+    def get_children_containing(self, points: np.ndarray) -> typing.List[typing.List['VectorNode']]:
+        """
+        Returns the children containing each point, using the spatial index of the children
+        :param points: an array of points, in the same coordinates as the exteriors
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        query_indices, child_indices = self.get_child_index().query(shapely.points(points), predicate="within")
+        return self._group_children(query_indices, child_indices, len(points))
+
+    def get_intersecting_children(
+            self, polygon: POLYGON_TYPE, border_touching: bool = True
+    ) -> typing.List['VectorNode']:
+        """
+        Returns the children touching the polygon, using the spatial index of the children
+        :param border_touching: if False, children which only share a border with the polygon are excluded
+        """
+        polygon = self._convert_to_shapely(polygon)
+        child_indices = self.get_child_index().query(polygon, predicate="intersects")
+
+        if not border_touching and len(child_indices) > 0:
+            geometries = self.get_child_index().geometries
+            child_indices = child_indices[self._get_intersection_areas(geometries[child_indices], polygon) > 0]
+
+        return [self.children[i] for i in np.sort(child_indices).tolist()]
+
+    def get_child_neighbours(self, border_touching: bool = True) -> typing.List[typing.List['VectorNode']]:
+        """
+        Returns the other children touching each child, using the spatial index of the children
+        :param border_touching: if False, children which only share a border are not neighbours
+        """
+        tree = self.get_child_index()
+        geometries = tree.geometries
+
+        query_indices, child_indices = tree.query(geometries, predicate="intersects")
+        distinct = query_indices != child_indices
+        query_indices, child_indices = query_indices[distinct], child_indices[distinct]
+
+        if not border_touching and len(query_indices) > 0:
+            overlapping = self._get_intersection_areas(geometries[query_indices], geometries[child_indices]) > 0
+            query_indices, child_indices = query_indices[overlapping], child_indices[overlapping]
+
+        return self._group_children(query_indices, child_indices, len(geometries))
+
+    def get_nearest_children(self, points: np.ndarray, k: int = 1) -> typing.List[typing.List['VectorNode']]:
+        """
+        Returns the k children with the closest centroids to each point, from closest to furthest
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        k = min(k, len(self.children))
+
+        if k == 0:
+            return [[] for _ in range(len(points))]
+
+        self.get_child_index()
+        _, child_indices = self._child_index[3].query(points, k=k)
+
+        return [[self.children[i] for i in row] for row in child_indices.reshape(len(points), k).tolist()]
+
     def get_children_by_category(self) -> dict:
         result = {}
 
@@ -45,13 +351,20 @@ class VectorNode(base_node.BaseNode):
         return result
 
     def as_shapely(self) -> shapely.Polygon:
-        return shapely.Polygon(self.exterior)
+        if self._geometry is None:
+            self._geometry = shapely.Polygon(self.exterior)
+
+        return self._geometry
 
     def from_shapely(self, polygon: shapely.Polygon):
         self.exterior = np.array(polygon.exterior.coords).astype(float)
 
+    @_cached_metric
+    def _get_centroid(self) -> np.ndarray:
+        return np.array(self.as_shapely().centroid.coords)[0]
+
     def get_centroid(self, yx: bool = False) -> np.ndarray:
-        centroid = np.array(self.as_shapely().centroid.coords)[0]
+        centroid = self._get_centroid().copy()
 
         if yx:
             centroid = centroid[::-1]
@@ -123,9 +436,11 @@ class VectorNode(base_node.BaseNode):
     def get_unique_child_categories(self):
         return np.unique([c.category for c in self.children])
 
+    @_cached_metric
     def get_area(self) -> float:
         return self.as_shapely().area
 
+    @_cached_metric
     def get_perimeter(self) -> float:
         return self.as_shapely().length
 
@@ -139,10 +454,10 @@ class VectorNode(base_node.BaseNode):
         return self.get_bounding_width() / self.get_bounding_height()
 
     def get_reock_score(self) -> float:
-        return self.as_shapely().area / self.get_bounding_circle_area()
+        return self.get_area() / self.get_bounding_circle_area()
 
     def get_convex_hull_score(self) -> float:
-        return self.as_shapely().area / self.get_convex_hull().area
+        return self.get_area() / self.get_convex_hull().area
 
     def get_elongation(self) -> float:
         """
@@ -155,11 +470,16 @@ class VectorNode(base_node.BaseNode):
 
         return min(area, perimeter) / max(area, perimeter)
 
+    @_cached_metric
     def get_convex_hull(self) -> shapely.Polygon:
         return self.as_shapely().convex_hull
 
+    @_cached_metric
+    def _get_bounds(self) -> typing.Tuple[float, float, float, float]:
+        return self.as_shapely().bounds
+
     def get_bounding_box(self) -> np.ndarray:
-        min_x, min_y, max_x, max_y = self.as_shapely().bounds
+        min_x, min_y, max_x, max_y = self._get_bounds()
 
         return np.array([
             (min_x, min_y),
@@ -169,11 +489,11 @@ class VectorNode(base_node.BaseNode):
         ])
 
     def get_bounding_width(self) -> float:
-        min_x, min_y, max_x, max_y = self.as_shapely().bounds
+        min_x, min_y, max_x, max_y = self._get_bounds()
         return max_x - min_x
 
     def get_bounding_height(self) -> float:
-        min_x, min_y, max_x, max_y = self.as_shapely().bounds
+        min_x, min_y, max_x, max_y = self._get_bounds()
         return max_y - min_y
 
     def distance_to_point(self, point: np.ndarray) -> float:
@@ -189,9 +509,11 @@ class VectorNode(base_node.BaseNode):
 
         return polygon
 
+    @_cached_metric
     def get_bounding_circle(self) -> shapely.Polygon:
         return shapely.minimum_bounding_circle(self.as_shapely())
 
+    @_cached_metric
     def get_bounding_circle_radius(self) -> float:
         return shapely.minimum_bounding_radius(self.as_shapely())
 
@@ -234,37 +556,88 @@ class VectorNode(base_node.BaseNode):
         return self.as_shapely().contains(shapely.Point(point))
 
     def refit_to_parent(self, recursive: bool = True):
+        """
+        Clips the children to this polygon. Children outside of it are removed, and children split into several
+        polygons are replaced by a copy for each part, added after the other children.
+        The children are first classified using the spatial index of the children. Children whose bounding boxes do
+        not overlap are outside, and children covered by this polygon are kept unchanged, so only the children crossing
+        the border are intersected, all at once.
+        """
+        if len(self.children) == 0:
+            return
+
         s = self.as_shapely()
+        geometries = self.get_geometries(self.children)
 
-        for child in self.children[:]:
-            try:
-                polygon = s.intersection(child.as_shapely())
-            except shapely.GEOSException:
-                polygon = s.buffer(0).intersection(child.as_shapely().buffer(0))
+        if len(self.children) < self.INDEXED_REFIT_MINIMUM:
+            # building the index costs more than it saves for a few children
+            candidates = np.arange(len(self.children))
+        else:
+            candidates = self.get_child_index().query(s)
 
-            if isinstance(
-                    polygon, (shapely.LineString, shapely.Point, shapely.MultiPoint, shapely.MultiLineString)
-            ) or polygon.is_empty:
+        # only children with bounding boxes inside this polygon's bounding box can be covered by it
+        min_x, min_y, max_x, max_y = shapely.bounds(geometries[candidates]).T
+        parent_min_x, parent_min_y, parent_max_x, parent_max_y = s.bounds
+        in_box = candidates[
+            (min_x >= parent_min_x) & (min_y >= parent_min_y) & (max_x <= parent_max_x) & (max_y <= parent_max_y)
+        ]
+
+        shapely.prepare(s)
+        covered = set(in_box[shapely.covers(s, geometries[in_box])].tolist())
 
-                self.children.remove(child)
+        crossing = np.array([i for i in candidates.tolist() if i not in covered], dtype=np.int64)
+        intersections = dict(zip(crossing.tolist(), self._get_intersections(s, geometries[crossing])))
 
-            elif isinstance(polygon, (shapely.MultiPolygon, shapely.GeometryCollection)):
-                self.children.remove(child)
+        children = []
+        parts = []
+
+        for i, child in enumerate(self.children):
+            if i in covered:
+                children.append(child)
+                continue
+
+            # children outside of the bounding box have no intersection
+            polygon = intersections.get(i)
+
+            if polygon is None or polygon.is_empty or isinstance(
+                    polygon, (shapely.LineString, shapely.Point, shapely.MultiPoint, shapely.MultiLineString)
+            ):
+                continue
 
+            if isinstance(polygon, (shapely.MultiPolygon, shapely.GeometryCollection)):
                 for p in polygon.geoms:
                     if isinstance(p, shapely.Polygon):
                         node = child.copy()
                         node.from_shapely(p)
-                        self.add_child(node)
-
-                        if recursive:
-                            node.refit_to_parent()
+                        parts.append(node)
 
             else:
                 child.from_shapely(polygon)
+                children.append(child)
+
+        self.children = children
+        self.add_children(parts)
+
+        if recursive:
+            for child in self.children:
+                child.refit_to_parent()
+
+    @staticmethod
+    def _get_intersections(polygon: shapely.Polygon, geometries: np.ndarray) -> np.ndarray:
+        try:
+            return shapely.intersection(polygon, geometries)
 
-                if recursive:
-                    child.refit_to_parent()
+        except shapely.GEOSException:
+            # only the intersections which fail are retried with repaired geometry
+            result = np.empty(len(geometries), dtype=object)
+
+            for i, geometry in enumerate(geometries):
+                try:
+                    result[i] = polygon.intersection(geometry)
+                except shapely.GEOSException:
+                    result[i] = polygon.buffer(0).intersection(geometry.buffer(0))
+
+            return result
 
     def to_svg(self, filename: str):
         dwg = svgwrite.Drawing(filename, profile='tiny', size=(self.get_bounding_height(), self.get_bounding_width()))
@@ -295,25 +668,57 @@ class VectorNode(base_node.BaseNode):
 
         surface.save(filename)
 
-    def rotate(self, angle: float):
-        centroid = tuple(self.get_centroid())
+    @staticmethod
+    def get_rotation_matrix(angle: float, origin: tuple = (0, 0)) -> np.ndarray:
+        """
+        Returns the 2x3 affine matrix rotating counterclockwise by the angle (in radians) around the origin
+        """
+        cos, sin = math.cos(angle), math.sin(angle)
+        return VectorNode._around_origin(np.array([[cos, -sin], [sin, cos]]), origin)
+
+    @staticmethod
+    def get_scale_matrix(x_scale: float = 1, y_scale: float = 1, origin: tuple = (0, 0)) -> np.ndarray:
+        """
+        Returns the 2x3 affine matrix scaling by the factors around the origin
+        """
+        return VectorNode._around_origin(np.diag([x_scale, y_scale]).astype(float), origin)
 
-        for child in self.level_order_traversal():
-            rotated = shapely.affinity.rotate(child.as_shapely(), angle, centroid, use_radians=True)
-            child.from_shapely(rotated)
+    @staticmethod
+    def _around_origin(linear: np.ndarray, origin: tuple) -> np.ndarray:
+        origin = np.asarray(origin, dtype=np.float64)
+        return np.column_stack((linear, origin - linear @ origin))
 
-    def scale(self, x_scale: float = 1, y_scale: float = 1):
-        centroid = tuple(self.get_centroid())
+    def transform(self, matrix: np.ndarray):
+        """
+        Applies the 2x3 affine matrix to this node and every descendant, transforming the exteriors of the whole
+        subtree as a single array
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        nodes = list(self.level_order_traversal())
 
-        for child in self.level_order_traversal():
-            scaled = shapely.affinity.scale(child.as_shapely(), x_scale, y_scale, origin=centroid)
-            child.from_shapely(scaled)
+        exteriors = [np.asarray(node.exterior, dtype=np.float64).reshape(-1, 2) for node in nodes]
+        offsets = np.cumsum([len(e) for e in exteriors])[:-1]
+
+        coordinates = np.concatenate(exteriors) @ matrix[:, :2].T + matrix[:, 2]
+
+        for node, exterior in zip(nodes, np.split(coordinates, offsets)):
+            node.exterior = exterior
+
+    def rotate(self, angle: float):
+        self.transform(self.get_rotation_matrix(angle, self.get_centroid()))
+
+    def scale(self, x_scale: float = 1, y_scale: float = 1):
+        self.transform(self.get_scale_matrix(x_scale, y_scale, self.get_centroid()))
 
     def synthesize_children(
             self, quantity: float, top: float = 0.25,
             rotation_range: tuple = (-math.pi / 4, math.pi / 4),
             scale_range: tuple = (8/9, 9/8)
     ):
+        """
+        Adds randomly scaled and rotated copies of the children with the largest area and compactness. The scales and
+        angles of every copy are drawn at once, and each copy is created directly from its transformed coordinates.
+        """
         if scale_range is None and rotation_range is None:
             return
 
@@ -324,8 +729,12 @@ class VectorNode(base_node.BaseNode):
 
         quantity = int(quantity)
 
-        areas = np.array([c.get_area() for c in self.children])
-        compactness = np.array([c.get_polsby_popper_compactness() for c in self.children])
+        if quantity == 0:
+            return []
+
+        metrics = self.get_metrics(self.children)
+        areas = metrics["area"]
+        compactness = metrics["polsby_popper_compactness"]
 
         areas -= areas.min()
         areas /= areas.max()
@@ -338,26 +747,85 @@ class VectorNode(base_node.BaseNode):
 
         candidate_indices = np.argpartition(distances, total_candidates)[-total_candidates:]
 
-        children = []
-        for _ in tqdm.tqdm(range(quantity), total=quantity):
-            parent_index = np.random.choice(candidate_indices)
-            new_child = self.children[parent_index].copy()
+        parent_indices = np.random.choice(candidate_indices, quantity)
+
+        # each copy is scaled and then rotated around the centroid of the child it copies
+        linear = np.broadcast_to(np.eye(2), (quantity, 2, 2))
+
+        if scale_range is not None:
+            scales = np.random.uniform(*scale_range, size=(quantity, 2))
+            linear = scales[:, None, :] * linear
+
+        if rotation_range is not None:
+            angles = np.random.uniform(*rotation_range, size=quantity)
+            cos, sin = np.cos(angles), np.sin(angles)
+            rotations = np.stack((np.stack((cos, -sin), axis=1), np.stack((sin, cos), axis=1)), axis=1)
+            linear = rotations @ linear
+
+        centroids = metrics["centroid"][parent_indices]
+        offsets = centroids - np.einsum('nij,nj->ni', linear, centroids)
 
-            if scale_range is not None:
-                scale_x = np.random.uniform(*scale_range)
-                scale_y = np.random.uniform(*scale_range)
-                new_child.scale(scale_x, scale_y)
+        templates = {i: self._get_template(self.children[i]) for i in np.unique(parent_indices).tolist()}
 
-            if rotation_range is not None:
-                angle = np.random.uniform(*rotation_range)
-                new_child.rotate(angle)
+        # the coordinates of every copy, including the descendants of the copied children, are transformed together
+        point_counts = [len(templates[i][1]) for i in parent_indices.tolist()]
+        points = np.concatenate([templates[i][1] for i in parent_indices.tolist()])
 
+        point_copies = np.repeat(np.arange(quantity), point_counts)
+        points = np.einsum('nij,nj->ni', linear[point_copies], points) + offsets[point_copies]
+
+        children = []
+        for parent_index, copy_points in tqdm.tqdm(
+                zip(parent_indices.tolist(), np.split(points, np.cumsum(point_counts)[:-1])), total=quantity
+        ):
+            new_child = self._from_template(templates[parent_index], copy_points)
             new_child.synthetic = True
-            self.add_child(new_child)
             children.append(new_child)
 
+        self.add_children(children)
+
         return children
 
+    @staticmethod
+    def _get_template(node: 'VectorNode') -> tuple:
+        """
+        Returns the nodes of the subtree in pre-order, their stacked exteriors, the offsets of each exterior and the
+        index of each node's parent in the subtree
+        """
+        nodes = list(node.pre_order_traversal())
+        indices = {id(n): i for i, n in enumerate(nodes)}
+
+        exteriors = [np.asarray(n.exterior, dtype=np.float64).reshape(-1, 2) for n in nodes]
+        offsets = np.concatenate(([0], np.cumsum([len(e) for e in exteriors])))
+
+        parents = [-1] * len(nodes)
+        for i, n in enumerate(nodes):
+            for child in n.children:
+                parents[indices[id(child)]] = i
+
+        return nodes, np.concatenate(exteriors), offsets.tolist(), parents
+
+    @staticmethod
+    def _from_template(template: tuple, points: np.ndarray) -> 'VectorNode':
+        """
+        Creates a copy of the subtree of the template with the exteriors replaced by the points
+        """
+        nodes, _, offsets, parents = template
+
+        copies = []
+        for i, node in enumerate(nodes):
+            new_node = VectorNode(
+                points[offsets[i]:offsets[i + 1]], node.category,
+                None if node.color is None else np.array(node.color), node.level
+            )
+            new_node.synthetic = node.synthetic
+            copies.append(new_node)
+
+            if parents[i] >= 0:
+                copies[parents[i]].children.append(new_node)
+
+        return copies[0]
+
     def get_category_density(self, normalize: bool = True) -> tuple:
         categories = [c.category for c in self.children if not c.synthetic]
         unique, counts = np.unique(categories, return_counts=True)
@@ -367,14 +835,53 @@ class VectorNode(base_node.BaseNode):
 
         return unique, counts
 
-    def to_dict(self) -> dict:
-        result = {
+    def to_record(self) -> dict:
+        return {
             "coordinates": self.exterior.tolist(),
-            "children": [],
             "color": self.color_to_int().tolist()
         }
 
-        for child in self.children:
-            result["children"].append(child.to_dict())
+    @classmethod
+    def from_record(cls, record: dict, version: int = base_node.JSON_VERSION) -> 'VectorNode':
+        return cls(np.array(record["coordinates"]), color=cls.color_from_int(record["color"]))
 
-        return result
+
+class LazyVectorNode(VectorNode):
+    """
+    Node of a tree opened from a columnar file. The exterior is a copy on write view of the memory mapped file, so
+    modifying it in place does not change the file, and the child nodes are only created when the children are first
+    accessed.
+    """
+    def __init__(
+            self, tree: columnar.ColumnarTree, index: int, exterior: np.ndarray, category: int = None,
+            color: np.ndarray = None, level: int = 0, synthetic: bool = False
+    ):
+        super().__init__(exterior, category, color, level)
+        self.synthetic = synthetic
+
+        self.tree = tree
+        self.index = index
+        self._children = None
+
+    @classmethod
+    def from_tree(cls, tree: columnar.ColumnarTree, indices: typing.Iterable[int]) -> typing.List['LazyVectorNode']:
+        indices = np.asarray(indices, dtype=np.int64)
+        return [cls(tree, i, *node) for i, node in zip(indices.tolist(), tree.get_nodes(indices))]
+
+    @property
+    def children(self) -> ChildList:
+        if self._children is None:
+            self._children = ChildList(self.from_tree(self.tree, self.tree.get_child_indices(self.index)))
+
+        return self._children
+
+    @children.setter
+    def children(self, children: typing.List[VectorNode]):
+        self._children = children if isinstance(children, ChildList) else ChildList(children)
+
+    def __getstate__(self) -> dict:
+        # copies and pickles hold the whole subtree in memory instead of referring to the file
+        state = super().__getstate__()
+        state.update(_children=self.children, tree=None, _exterior=np.array(self.exterior))
+
+        return state